@@ -0,0 +1,165 @@
+'''
+Throughput of the hot paths of the GSN, on synthetic data, without a training job.
+
+For every point of the matrix of --K, --N, --hidden_size, --batch_size, --act and --scan
+(comma-separated values), a model is built and measured :
+
+    compile_time            seconds to build and compile the functions of the model
+    learn_rows_per_sec      training rows per second through f_learn
+    sample_steps_per_sec    steps per second of the sampling chain of the plots (sample_some_numbers of model.experiment)
+    inpaint_images_per_sec  images per second inpainted by GSN.inpaint, with its default 50 steps
+
+and, once :
+
+    parzen_rows_per_sec     test rows per second of the parzen estimate of likelihood_estimation_parzen.main
+    tile_images_per_sec     images per second tiled by tile_raster_images
+
+Every measure is the best of --repeat measures (the highest throughput, the shortest compile_time) :
+noise on a busy machine only makes a measure slower, so the best one varies much less than the median.
+The results are written as JSON to --output.
+With --baseline, they are compared to the results of an earlier run, and the exit status is 1
+when one of them is slower by more than --tolerance.
+
+    THEANO_FLAGS=mode=FAST_RUN,device=cpu,floatX=float32 python benchmark.py --K 1,2 --hidden_size 500,1500 --baseline benchmark_baseline.json
+'''
+import argparse
+import itertools
+import json
+import sys
+import time
+import numpy
+import theano
+import model
+import likelihood_estimation_parzen
+import run_gsn
+from image_tiler import tile_raster_images
+
+N_INPUT     =   28*28
+
+def synthetic_data(n_rows, seed=1):
+    # Binary rows of N_INPUT pixels, about one in five on
+    return (numpy.random.RandomState(seed).uniform(size=(n_rows, N_INPUT)) < 0.2).astype('float32')
+
+def throughput(function, count, repeat):
+    # Best over repeat calls of function (after one warm-up call) of count / duration
+    function()
+    rates   =   []
+    for i in range(repeat):
+        start   =   time.time()
+        function()
+        rates.append(count / (time.time() - start))
+    return float(max(rates))
+
+def benchmark_model(config, args):
+    state   =   run_gsn.get_parser().parse_args([])
+    for name, value in config.items():
+        setattr(state, name, value)
+    # always compiled, to measure it, and built --repeat times : a single build is too noisy to compare
+    state.function_cache    =   0
+    compile_times   =   []
+    for i in range(args.repeat):
+        numpy.random.seed(1)
+        start   =   time.time()
+        gsn     =   model.GSN(state, N_INPUT)
+        compile_times.append(time.time() - start)
+    compile_time    =   float(min(compile_times))
+
+    data    =   synthetic_data(args.learn_batches * state.batch_size)
+    gsn.train_X.set_value(data, borrow=True)
+    learn   =   throughput(gsn.train_epoch, len(data), args.repeat)
+
+    init_vis    =   data[:1]
+    if state.K == 1:
+        sample  =   throughput(lambda: gsn.sample_single_layer(init_vis, args.sample_steps), args.sample_steps, args.repeat)
+    else:
+        sample  =   throughput(lambda: gsn.sample(init_vis, args.sample_steps), args.sample_steps, args.repeat)
+
+    # the left halves of the images are inpainted, as in model.experiment
+    root_N_input    =   numpy.sqrt(N_INPUT)
+    fixed_mask  =   (numpy.arange(N_INPUT) % root_N_input > (root_N_input / 2))
+    inpaint     =   throughput(lambda: gsn.inpaint(data[:10], fixed_mask), 10, args.repeat)
+
+    return {'compile_time' : compile_time, 'learn_rows_per_sec' : learn, 'sample_steps_per_sec' : sample,
+            'inpaint_images_per_sec' : inpaint}
+
+def benchmark_parzen(args):
+    samples =   synthetic_data(args.parzen_samples, seed=2)
+    test_X  =   synthetic_data(args.parzen_rows, seed=3)
+    def parzen():
+        likelihood_estimation_parzen.get_ll(test_X, likelihood_estimation_parzen.blocked_parzen(samples, 0.2), batch_size=1000)
+    return throughput(parzen, len(test_X), args.repeat)
+
+def benchmark_tiling(args):
+    images  =   synthetic_data(400)
+    return throughput(lambda: tile_raster_images(images, (28, 28), (20, 20)), len(images), args.repeat)
+
+def environment():
+    return {'theano' : theano.__version__, 'numpy' : numpy.__version__, 'floatX' : theano.config.floatX,
+            'device' : theano.config.device, 'mode' : str(theano.config.mode), 'blas' : theano.config.blas.ldflags}
+
+def compare(results, baseline, tolerance):
+    # Lines of the relative changes from the baseline, and whether one of them is a regression
+    # (compile_time is slower when it grows, the throughputs when they drop)
+    lines       =   []
+    regression  =   False
+    base_models =   dict((json.dumps(r['config'], sort_keys=True), r) for r in baseline['models'])
+    measures    =   [('-', name, results[name], baseline.get(name)) for name in ['parzen_rows_per_sec', 'tile_images_per_sec']]
+    for r in results['models']:
+        base    =   base_models.get(json.dumps(r['config'], sort_keys=True), {})
+        label   =   ' '.join('%s=%s' % item for item in sorted(r['config'].items()))
+        measures    +=  [(label, name, r[name], base.get(name)) for name in ['compile_time', 'learn_rows_per_sec',
+                                                                               'sample_steps_per_sec', 'inpaint_images_per_sec']]
+    for label, name, current, base in measures:
+        if base is None:
+            lines.append('%-60s %-24s %12.2f %12s' % (label, name, current, 'no baseline'))
+            continue
+        relative    =   current / base - 1
+        slower      =   relative > tolerance if name == 'compile_time' else relative < -tolerance
+        regression  =   regression or slower
+        lines.append('%-60s %-24s %12.2f %12.2f %+7.1f%%%s' % (label, name, current, base, 100 * relative, '  <- slower' if slower else ''))
+    return lines, regression
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K', type=str, default='2') # comma-separated values of every option of the matrix
+    parser.add_argument('--N', type=str, default='4')
+    parser.add_argument('--hidden_size', type=str, default='1500')
+    parser.add_argument('--batch_size', type=str, default='100')
+    parser.add_argument('--act', type=str, default='tanh')
+    parser.add_argument('--scan', type=str, default='0')
+    parser.add_argument('--repeat', type=int, default=3) # measures of everything, the best one is kept
+    parser.add_argument('--learn_batches', type=int, default=20) # minibatches of a training measure
+    parser.add_argument('--sample_steps', type=int, default=400) # steps of a sampling measure
+    parser.add_argument('--parzen_samples', type=int, default=10000)
+    parser.add_argument('--parzen_rows', type=int, default=1000)
+    parser.add_argument('--output', type=str, default='benchmark.json')
+    parser.add_argument('--baseline', type=str, default='') # results of an earlier run to compare to
+    parser.add_argument('--tolerance', type=float, default=0.25) # relative slowdown reported as a regression, above the noise between runs
+    args = parser.parse_args()
+
+    types   =   [('K', int), ('N', int), ('hidden_size', int), ('batch_size', int), ('act', str), ('scan', int)]
+    matrix  =   [[(name, cast(value)) for value in getattr(args, name).split(',')] for name, cast in types]
+    results =   {'environment' : environment(), 'models' : []}
+    for config in itertools.product(*matrix):
+        config  =   dict(config)
+        print 'Benchmarking', config
+        measures    =   benchmark_model(config, args)
+        print measures
+        results['models'].append(dict(measures, config=config))
+    results['parzen_rows_per_sec']  =   benchmark_parzen(args)
+    results['tile_images_per_sec']  =   benchmark_tiling(args)
+    print 'parzen rows / s :', results['parzen_rows_per_sec'], '\ttiled images / s :', results['tile_images_per_sec']
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print 'Results saved to', args.output
+
+    if args.baseline:
+        lines, regression   =   compare(results, json.load(open(args.baseline)), args.tolerance)
+        print '\n'.join(lines)
+        if regression:
+            print 'Slower than the baseline', args.baseline
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
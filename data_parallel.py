@@ -0,0 +1,175 @@
+""" Data-parallel training of a GSN over several CPU cores.
+
+Each minibatch of the training loop is split between n_workers processes,
+forked from the training process once the functions of the model are
+compiled. Every worker computes the gradient of its batch_size rows with
+f_grad, from the parameters in shared memory, and writes it to its own
+shared memory buffer. The workers then average the gradients together,
+each over its own segment of the parameters, and the training process
+applies the momentum update of f_learn with the mean gradient (f_apply).
+
+One step thus trains on n_workers * batch_size rows, with the same
+parameters for every worker as in synchronous SGD.
+
+The noise of every worker comes from its own random streams. At the start
+of every epoch, they are derived from the random streams of the training
+process, which are saved in the checkpoints : a resumed training draws the
+same noise as one that was not interrupted.
+
+"""
+import multiprocessing
+import traceback
+import numpy
+import theano.sandbox.rng_mrg as RNG_MRG
+
+def shared_buffer(size):
+    return numpy.frombuffer(multiprocessing.RawArray('f', int(size)), dtype='float32')
+
+def matrix_power_mod(A, n, m):
+    # A**n modulo m, for a 3x3 matrix, in python integers
+    A       =   [[int(a) for a in row] for row in A]
+    power   =   [[int(i == j) for j in range(3)] for i in range(3)]
+    def product(X, Y):
+        return [[sum(X[i][k] * Y[k][j] for k in range(3)) % m for j in range(3)] for i in range(3)]
+    while n:
+        if n & 1:
+            power   =   product(power, A)
+        A   =   product(A, A)
+        n   >>= 1
+    return power
+
+def jump_streams(rstates, n_streams):
+    # The MRG states of rstates (rows of 6 numbers), each moved n_streams streams (of 2**134 numbers) ahead,
+    # as by n_streams calls of theano's ff_2p134
+    rstates =   numpy.asarray(rstates)
+    x       =   rstates.reshape((-1, 6)).astype('uint64')
+    jumped  =   numpy.empty_like(x)
+    for A, m, part in [(RNG_MRG.A1p134, int(RNG_MRG.M1), slice(0, 3)), (RNG_MRG.A2p134, int(RNG_MRG.M2), slice(3, 6))]:
+        power   =   numpy.asarray(matrix_power_mod(A, n_streams, m), dtype='uint64')
+        # products below 2**62 : no overflow
+        jumped[:, part] =   sum((x[:, part][:, j, None] * power[None, :, j]) % m for j in range(3)) % m
+    return jumped.astype(rstates.dtype).reshape(rstates.shape)
+
+def _work(worker, gsn, params, data, gradients, mean_gradient, costs, tasks, done):
+    # Runs in the worker processes : gradients of the rows of one shard, and the mean of a segment of all the gradients
+    try:
+        n_workers   =   len(gradients)
+        batch_size  =   gsn.batch_size
+        segments    =   numpy.linspace(0, len(mean_gradient), n_workers + 1).astype('int64')
+        lo, hi      =   segments[worker], segments[worker + 1]
+        gradient    =   split(gradients[worker], gsn.params)
+        while True:
+            task, start =   tasks.get()
+            if task == 'stop':
+                return
+            if task == 'seed':
+                # start is the list of the states of the random streams of the worker
+                for random_state, value in zip(gsn.random_states, start):
+                    random_state.set_value(value)
+            elif task == 'grad':
+                # the current parameters, without copy
+                for p, value in zip(gsn.params, split(params, gsn.params)):
+                    p.set_value(value, borrow=True)
+                rows        =   data[start + worker * batch_size : start + (worker + 1) * batch_size]
+                outputs     =   gsn.f_grad(rows)
+                costs[worker]   =   outputs[0]
+                for g, buf in zip(outputs[1:], gradient):
+                    buf[...]    =   g
+            elif task == 'reduce':
+                mean    =   mean_gradient[lo:hi]
+                mean[...]   =   gradients[0][lo:hi]
+                for g in gradients[1:]:
+                    mean    +=  g[lo:hi]
+                mean    *=  numpy.float32(1. / n_workers)
+            done.put((worker, None))
+    except Exception:
+        done.put((worker, traceback.format_exc()))
+
+def split(flat, params):
+    # Views of flat for the values of params, in their shapes
+    views   =   []
+    offset  =   0
+    for p in params:
+        shape   =   p.get_value(borrow=True).shape
+        size    =   int(numpy.prod(shape))
+        views.append(flat[offset : offset + size].reshape(shape))
+        offset  +=  size
+    return views
+
+class DataParallelTrainer(object):
+    '''
+    Trains gsn (compiled with n_workers > 1, see GSN.build_functions) with n_workers processes.
+
+    max_rows is the size of the largest chunk given to train_chunks.
+    The worker processes run until close is called.
+    '''
+    def __init__(self, gsn, n_workers, max_rows):
+        self.gsn        =   gsn
+        self.n_workers  =   n_workers
+        n_params        =   sum(p.get_value(borrow=True).size for p in gsn.params)
+        self.params     =   shared_buffer(n_params)
+        self.data       =   shared_buffer(max_rows * gsn.N_input).reshape((max_rows, gsn.N_input))
+        self.gradients  =   [shared_buffer(n_params) for i in range(n_workers)]
+        self.mean_gradient  =   shared_buffer(n_params)
+        self.costs      =   shared_buffer(n_workers)
+        self.tasks      =   [multiprocessing.Queue() for i in range(n_workers)]
+        self.done       =   multiprocessing.Queue()
+        self.sync_params()
+        self.processes  =   []
+        for worker in range(n_workers):
+            process =   multiprocessing.Process(target=_work, args=(worker, gsn, self.params, self.data, self.gradients,
+                                                                   self.mean_gradient, self.costs, self.tasks[worker], self.done))
+            process.daemon  =   True
+            process.start()
+            self.processes.append(process)
+
+    def sync_params(self):
+        # Copy the parameters of the training process to the shared memory the workers read them from
+        for value, p in zip(split(self.params, self.gsn.params), self.gsn.params):
+            value[...]  =   p.get_value(borrow=True)
+
+    def run(self, task, start=0):
+        # Run task on every worker (with start, or the start of every worker if it is a list), and wait for all of them
+        for worker, tasks in enumerate(self.tasks):
+            tasks.put((task, start[worker] if isinstance(start, list) else start))
+        for i in range(self.n_workers):
+            worker, error   =   self.done.get()
+            if error is not None:
+                raise RuntimeError('Training worker ' + str(worker) + ' failed :\n' + error)
+
+    def seed(self):
+        # The random streams of the workers, derived from the ones of the training process : for every random state,
+        # worker w gets the streams (w + 1) * K streams ahead, K the number of random states (they are the
+        # consecutive streams of GSN.MRG). The streams of the training process then move past all of them.
+        K   =   len(self.gsn.random_states)
+        states  =   [r.get_value(borrow=True) for r in self.gsn.random_states]
+        self.run('seed', [[jump_streams(value, (worker + 1) * K) for value in states] for worker in range(self.n_workers)])
+        for r, value in zip(self.gsn.random_states, states):
+            r.set_value(jump_streams(value, (self.n_workers + 1) * K))
+
+    def step(self, start):
+        # One synchronous update with the rows of data from start, batch_size rows per worker.
+        # Returns the mean cost of the rows.
+        self.run('grad', start)
+        self.run('reduce')
+        self.gsn.f_apply(*split(self.mean_gradient, self.gsn.params))
+        self.sync_params()
+        return self.costs.mean()
+
+    def train_chunks(self, chunks):
+        # As GSN.train_chunks, with n_workers * batch_size rows per update
+        # (the rows of the last incomplete one are skipped). Returns the mean training cost.
+        rows        =   self.n_workers * self.gsn.batch_size
+        train_cost  =   []
+        self.seed()
+        for chunk in chunks:
+            self.data[:len(chunk)]  =   chunk
+            for start in range(0, len(chunk) - rows + 1, rows):
+                train_cost.append(self.step(start))
+        return numpy.mean(train_cost)
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(('stop', 0))
+        for process in self.processes:
+            process.join()
@@ -0,0 +1,156 @@
+""" Input pipeline for the training loop of model.py.
+
+The training rows are read in float32 chunks, optionally reshuffled and
+stochastically binarized at every epoch. Binary rows can be kept bit-packed
+(PackedRows) and are only unpacked one chunk at a time. A Prefetcher prepares the next chunks
+in a background process, into shared memory buffers, while f_learn runs on the
+current one.
+
+"""
+import multiprocessing
+import traceback
+import numpy
+
+def pack_rows(X):
+    # Binary rows (values 0 or 1) packed 8 values per byte, as numpy.packbits
+    return numpy.packbits(numpy.asarray(X) > 0.5, axis=1)
+
+def unpack_rows(bits, n_dim):
+    return numpy.unpackbits(bits, axis=1)[:, :n_dim].astype('float32')
+
+class PackedRows(object):
+    '''
+    Binary rows of n_dim values, stored bit-packed (see pack_rows).
+
+    Indexing rows (an int, a slice or an index array) gives them unpacked in float32,
+    so that iterate_chunks reads them as any other array of rows, 32 times smaller.
+    '''
+    def __init__(self, bits, n_dim):
+        self.bits   =   bits
+        self.n_dim  =   n_dim
+
+    @property
+    def shape(self):
+        return (len(self.bits), self.n_dim)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, numpy.integer)):
+            return unpack_rows(self.bits[index : index + 1], self.n_dim)[0]
+        return unpack_rows(self.bits[index], self.n_dim)
+
+    def subset(self, index):
+        # the rows of index, still packed
+        return PackedRows(self.bits[index], self.n_dim)
+
+    def take(self, indices, axis=0):
+        return self[indices]
+
+    def sum(self, axis=0):
+        # per column, as X.sum(axis=0) for the mean of the rows
+        return sum(unpack_rows(self.bits[i : i + 10000], self.n_dim).sum(axis=0) for i in range(0, len(self.bits), 10000))
+
+def iterate_chunks(arrays, chunk_size, rng=None):
+    # Read the rows of arrays, as if they were concatenated, in float32 chunks of chunk_size rows.
+    # Only one chunk is copied in memory at a time, so the arrays can be memory-mapped files of any size.
+    # With rng, the chunks come in random order and the rows of each chunk are shuffled.
+    # Rows already in memory are instead taken in the order of a random permutation of all of them.
+    offsets =   numpy.cumsum([0] + [len(a) for a in arrays])
+    starts  =   numpy.arange(0, offsets[-1], chunk_size)
+    if rng is not None and len(arrays) == 1 and not isinstance(arrays[0], numpy.memmap):
+        permutation =   rng.permutation(offsets[-1])
+        for start in starts:
+            yield numpy.asarray(arrays[0].take(permutation[start : start + chunk_size], axis=0), dtype='float32')
+        return
+    if rng is not None:
+        rng.shuffle(starts)
+    for start in starts:
+        stop    =   min(start + chunk_size, offsets[-1])
+        chunk   =   numpy.empty((stop - start,) + arrays[0].shape[1:], dtype='float32')
+        for a, offset in zip(arrays, offsets):
+            lo, hi  =   max(start, offset), min(stop, offset + len(a))
+            if lo < hi:
+                chunk[lo - start : hi - start] = a[lo - offset : hi - offset]
+        if rng is not None:
+            rng.shuffle(chunk)
+        yield chunk
+
+def binarize_stochastic(chunk, rng):
+    # Each value is the probability of a 1
+    return (rng.uniform(size=chunk.shape) < chunk).astype('float32')
+
+def training_chunks(arrays, chunk_size, epochs, seed=1, shuffle=True, binarize=False):
+    # The chunks of a pass over the training rows for every epoch number in epochs, each pass followed by None.
+    # With shuffle, rows are reshuffled at every pass (see iterate_chunks).
+    # The random numbers of a pass only depend on seed and on its epoch number,
+    # so that training can be resumed at any epoch with the same data.
+    for epoch in epochs:
+        rng = numpy.random.RandomState([seed, epoch])
+        for chunk in iterate_chunks(arrays, chunk_size, rng if shuffle else None):
+            if binarize:
+                chunk = binarize_stochastic(chunk, rng)
+            yield chunk
+        yield None
+
+def _produce(chunks, buffers, free, ready):
+    # Runs in the background process : copies every chunk into a free buffer
+    try:
+        for chunk in chunks:
+            if chunk is None:
+                ready.put((None, 0))
+                continue
+            i = free.get()
+            buffers[i][:len(chunk)] = chunk
+            ready.put((i, len(chunk)))
+        ready.put(('end', 0))
+    except Exception:
+        ready.put(('error', traceback.format_exc()))
+
+class Prefetcher(object):
+    '''
+    Iterates over chunks (as produced by training_chunks) prepared by a background process.
+
+    The process fills n_buffers shared memory buffers of max_rows x n_dim float32,
+    so up to n_buffers - 1 chunks are ready while the current one is used.
+    A chunk yielded by the iteration stays valid until the next one is requested.
+    None items are passed through as they are.
+    '''
+    def __init__(self, chunks, max_rows, n_dim, n_buffers=2):
+        self.buffers    =   [numpy.frombuffer(multiprocessing.RawArray('f', max_rows * n_dim), dtype='float32').reshape((max_rows, n_dim))
+                             for i in range(n_buffers)]
+        self.free       =   multiprocessing.Queue()
+        self.ready      =   multiprocessing.Queue()
+        for i in range(n_buffers):
+            self.free.put(i)
+        self.process    =   multiprocessing.Process(target=_produce, args=(chunks, self.buffers, self.free, self.ready))
+        self.process.daemon =   True
+        self.process.start()
+
+    def __iter__(self):
+        previous    =   None
+        while True:
+            # the previous chunk is not used anymore : it can be refilled
+            if previous is not None:
+                self.free.put(previous)
+                previous    =   None
+            i, n = self.ready.get()
+            if i == 'error':
+                raise RuntimeError('Prefetching process failed :\n' + n)
+            if i == 'end':
+                return
+            if i is None:
+                yield None
+                continue
+            previous    =   i
+            yield self.buffers[i][:n]
+
+    def close(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
@@ -3,18 +3,20 @@ in anyway to the networks presented in the tutorials, but rather help in
 processing the outputs into a more understandable way.
 
 For example ``tile_raster_images`` helps in generating a easy to grasp
-image from a set of samples or weights.
+image from a set of samples or weights, and ``image_writer`` saves such
+images in the background.
 
 """
 
 
 import numpy, os, cPickle
+import threading, Queue, traceback, atexit, time
 from PIL import Image
 
 def load_mnist():
-    path = '.'
-    data = cPickle.load(open(os.path.join(path,'mnist.pkl'), 'r'))
-    return data
+    # memory-mapped from the dataset cache of model.py
+    import model
+    return model.load_mnist('.')
 
 def scale_to_unit_interval(ndar, eps=1e-8):
     """ Scales all values in the ndarray ndar to be between 0 and 1 """
@@ -91,55 +93,144 @@ def tile_raster_images(X, img_shape, tile_shape, tile_spacing=(0, 0),
 
         for i in xrange(4):
             if X[i] is None:
-                # if channel is None, fill it with zeros of the correct
-                # dtype
-                dt = out_array.dtype
-                if output_pixel_vals:
-                    dt = 'uint8'
-                out_array[:, :, i] = numpy.zeros(out_shape,
-                        dtype=dt) + channel_defaults[i]
+                # if channel is None, fill it with the default value
+                out_array[:, :, i] = channel_defaults[i]
             else:
-                # use a recurrent call to compute the channel and store it
-                # in the output
-                out_array[:, :, i] = tile_raster_images(
-                    X[i], img_shape, tile_shape, tile_spacing,
-                    scale_rows_to_unit_interval, output_pixel_vals)
+                # compute the channel directly in the output
+                _tile_into(out_array[:, :, i], X[i], img_shape, tile_shape,
+                           tile_spacing, scale_rows_to_unit_interval,
+                           output_pixel_vals)
         return out_array
 
     else:
         # if we are dealing with only one channel
-        H, W = img_shape
-        Hs, Ws = tile_spacing
-
         # generate a matrix to store the output
         dt = X.dtype
         if output_pixel_vals:
             dt = 'uint8'
         out_array = numpy.zeros(out_shape, dtype=dt)
-
-        for tile_row in xrange(tile_shape[0]):
-            for tile_col in xrange(tile_shape[1]):
-                if tile_row * tile_shape[1] + tile_col < X.shape[0]:
-                    this_x = X[tile_row * tile_shape[1] + tile_col]
-                    if scale_rows_to_unit_interval:
-                        # if we should scale values to be between 0 and 1
-                        # do this by calling the `scale_to_unit_interval`
-                        # function
-                        this_img = scale_to_unit_interval(
-                            this_x.reshape(img_shape))
-                    else:
-                        this_img = this_x.reshape(img_shape)
-                    # add the slice to the corresponding position in the
-                    # output array
-                    c = 1
-                    if output_pixel_vals:
-                        c = 255
-                    out_array[
-                        tile_row * (H + Hs): tile_row * (H + Hs) + H,
-                        tile_col * (W + Ws): tile_col * (W + Ws) + W
-                        ] = this_img * c
+        _tile_into(out_array, X, img_shape, tile_shape, tile_spacing,
+                   scale_rows_to_unit_interval, output_pixel_vals)
         return out_array
 
+
+def _tile_into(out_array, X, img_shape, tile_shape, tile_spacing,
+               scale_rows_to_unit_interval, output_pixel_vals):
+    """ Writes the tiles of the rows of X into the 2-D array out_array
+    (see tile_raster_images), which can be a view of a channel """
+    H, W = img_shape
+    Hs, Ws = tile_spacing
+    n_tiles = min(X.shape[0], tile_shape[0] * tile_shape[1])
+    if n_tiles == 0:
+        return
+
+    images = X[:n_tiles].reshape((n_tiles, H * W))
+    if scale_rows_to_unit_interval:
+        # same as scale_to_unit_interval on every row, at once : the
+        # factor is computed in double precision, then applied in the
+        # dtype of X
+        images = images - images.min(axis=1)[:, None]
+        factors = 1.0 / (images.max(axis=1).astype('float64') + 1e-8)
+        images *= factors.astype(images.dtype)[:, None]
+    c = 1
+    if output_pixel_vals:
+        c = 255
+    images = images * c
+
+    # view of out_array as (tile row, pixel row, tile col, pixel col) :
+    # all the tiles are written with one assignment per row of tiles
+    # that is full, plus one for the last partial row
+    row_stride, col_stride = out_array.strides
+    tiles = numpy.lib.stride_tricks.as_strided(
+        out_array, shape=(tile_shape[0], H, tile_shape[1], W),
+        strides=((H + Hs) * row_stride, row_stride,
+                 (W + Ws) * col_stride, col_stride))
+    images = images.reshape((n_tiles, H, W))
+    n_full = n_tiles // tile_shape[1]
+    tiles[:n_full] = images[:n_full * tile_shape[1]].reshape(
+        (n_full, tile_shape[1], H, W)).transpose(0, 2, 1, 3)
+    n_last = n_tiles - n_full * tile_shape[1]
+    if n_last:
+        tiles[n_full, :, :n_last] = images[n_full * tile_shape[1]:].transpose(1, 0, 2)
+
+class ImageWriter(object):
+    """
+    Runs image writing functions in a background thread, in order, so
+    that the caller does not wait for the tiling and PNG encoding.
+
+    At most max_pending calls wait in the queue : beyond that, submit
+    blocks until one is done. The arrays given must not be modified
+    afterwards. An error in the thread is raised by the next submit or
+    flush. times holds the seconds spent so far in the tiling and in
+    the PNG encoding of save_tiles.
+    """
+    def __init__(self, max_pending=16):
+        self.queue = Queue.Queue(max_pending)
+        self.error = None
+        self.times = {'tiling': 0., 'png': 0.}
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                function, args = item
+                try:
+                    function(*args)
+                except Exception:
+                    self.error = traceback.format_exc()
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing an image failed :\n' + error)
+
+    def submit(self, function, *args):
+        self._check()
+        self.queue.put((function, args))
+
+    def save_tiles(self, path, X, img_shape, tile_shape, tile_spacing=(0, 0)):
+        """ Saves tile_raster_images(X, ...) as a picture at path """
+        self.submit(self._save_tiles, path, X, img_shape, tile_shape, tile_spacing)
+
+    def _save_tiles(self, path, X, img_shape, tile_shape, tile_spacing):
+        start = time.time()
+        image = Image.fromarray(tile_raster_images(X, img_shape, tile_shape,
+                                                   tile_spacing))
+        tiled = time.time()
+        image.save(path)
+        self.times['tiling'] += tiled - start
+        self.times['png'] += time.time() - tiled
+
+    def flush(self):
+        """ Waits until all the submitted images are written """
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
+
+
+_image_writer = None
+
+def image_writer():
+    """ The ImageWriter shared by the module, which is flushed at exit """
+    global _image_writer
+    if _image_writer is None:
+        _image_writer = ImageWriter()
+        atexit.register(_image_writer.close)
+    return _image_writer
+
+
 def visualize_mnist():
     (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_mnist()
     design_matrix = train_X
@@ -5,6 +5,7 @@ import sys
 import os
 import numpy
 import cPickle, gzip
+import hashlib
 import time
 
 import theano
@@ -51,6 +52,149 @@ def numpy_parzen(x, mu, sigma):
     return log_mean(-0.5 * (a**2).sum(2)) - mu.shape[1] * numpy.log(sigma * numpy.sqrt(numpy.pi * 2))
 
 
+# Bytes of the blocks of distances computed at once (in parzen_sweep, together with their scratch block)
+MEMORY_BUDGET = 256 * 2**20
+
+
+def squared_distance_blocks(x, mu, memory_budget=MEMORY_BUDGET):
+    """
+    Squared euclidean distances between the rows of x and the rows of mu,
+    computed with BLAS as ||x||^2 - 2 x.mu^T + ||mu||^2.
+    Yields (x_slice, mu_slice, D) blocks, where D[i, j] is the distance between
+    x[x_slice][i] and mu[mu_slice][j]. The blocks go over mu first, for every block of x rows.
+    """
+    x = numpy.asarray(x, dtype='float32')
+    mu = numpy.asarray(mu, dtype='float32')
+    itemsize = x.dtype.itemsize
+    mu_block = int(min(len(mu), max(1, memory_budget / itemsize)))
+    x_block = int(max(1, memory_budget / (itemsize * mu_block)))
+    mu_sq = (mu**2).sum(1)
+    for i in range(0, len(x), x_block):
+        x_slice = slice(i, min(i + x_block, len(x)))
+        x_i = x[x_slice]
+        x_sq = (x_i**2).sum(1)
+        for j in range(0, len(mu), mu_block):
+            mu_slice = slice(j, min(j + mu_block, len(mu)))
+            D = numpy.dot(x_i, mu[mu_slice].T)
+            D *= -2
+            D += x_sq[:, None]
+            D += mu_sq[None, mu_slice]
+            # rounding errors can make distances slightly negative
+            numpy.maximum(D, 0, out=D)
+            yield x_slice, mu_slice, D
+
+
+def stored_distance_blocks(distances, memory_budget=MEMORY_BUDGET):
+    """
+    Same as squared_distance_blocks, for a matrix of distances already computed,
+    e.g. memory-mapped from the cache (see cached_squared_distances) : it is read in blocks of rows.
+    """
+    n_rows = int(max(1, memory_budget / (distances.dtype.itemsize * distances.shape[1])))
+    for i in range(0, len(distances), n_rows):
+        x_slice = slice(i, min(i + n_rows, len(distances)))
+        yield x_slice, slice(None), numpy.asarray(distances[x_slice])
+
+
+def parzen_sweep(x, mu, sigmas, memory_budget=MEMORY_BUDGET, distances=None):
+    """
+    Log-likelihood of the rows of x under the Parzen windows centered on mu,
+    for every bandwidth in sigmas : an array of shape (len(sigmas), len(x)).
+    The distances do not depend on sigma, so they are computed only once (see squared_distance_blocks),
+    and the log-mean-exp of every sigma is accumulated across the blocks of samples.
+    distances is the matrix of squared distances, if it is already computed.
+    The exponents of a block are computed in place in a float32 scratch block of the same size,
+    so memory_budget is shared between the two blocks. The scratch block is allocated once,
+    for the first (largest) block, and reused for every block and sigma.
+    """
+    sigmas = numpy.asarray(sigmas, dtype='float64')
+    Z = mu.shape[1] * numpy.log(sigmas * numpy.sqrt(numpy.pi * 2))
+    # running maximum and sum of exp(E - maximum), for every sigma and row of x
+    max_ = numpy.empty((len(sigmas), len(x)))
+    max_.fill(-numpy.inf)
+    sum_ = numpy.zeros((len(sigmas), len(x)))
+    if distances is None:
+        blocks = squared_distance_blocks(x, mu, memory_budget / 2)
+    else:
+        blocks = stored_distance_blocks(distances, memory_budget / 2)
+    scratch = None
+    for x_slice, mu_slice, D in blocks:
+        if scratch is None:
+            scratch = numpy.empty(D.shape, dtype='float32')
+        E = scratch[:D.shape[0], :D.shape[1]]
+        for k, sigma in enumerate(sigmas):
+            numpy.multiply(D, numpy.float32(-0.5 / sigma**2), out=E)
+            new_max = numpy.maximum(max_[k, x_slice], E.max(1))
+            numpy.subtract(E, new_max[:, None], out=E, casting='same_kind')
+            numpy.exp(E, out=E)
+            sum_[k, x_slice] = sum_[k, x_slice] * numpy.exp(max_[k, x_slice] - new_max) + E.sum(1, dtype='float64')
+            max_[k, x_slice] = new_max
+    return max_ + numpy.log(sum_ / len(mu)) - Z[:, None]
+
+
+def blocked_parzen(mu, sigma, memory_budget=MEMORY_BUDGET):
+    """
+    Same as theano_parzen, without the (batch, n_samples, dim) difference tensor :
+    the distances are computed in blocks of at most memory_budget bytes (see parzen_sweep).
+    """
+    def parzen(x):
+        return parzen_sweep(x, mu, [sigma], memory_budget)[0]
+
+    return parzen
+
+
+def cached_squared_distances(x, mu, cache_dir, memory_budget=MEMORY_BUDGET):
+    """
+    The squared distances between the rows of x and mu, memory-mapped from a .npy file of cache_dir.
+    The file is named by the content hashes of x and mu : it is computed and saved the first time only.
+    """
+    h = hashlib.md5()
+    for a in [x, mu]:
+        a = numpy.ascontiguousarray(a, dtype='float32')
+        h.update(str(a.shape))
+        h.update(a.data)
+    path = os.path.join(cache_dir, h.hexdigest() + '.npy')
+    if not os.path.isfile(path):
+        print 'Computing the distances into', path
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = path[:-len('.npy')] + '.' + str(os.getpid()) + '.npy'
+        distances = numpy.lib.format.open_memmap(tmp_path, mode='w+', dtype='float32', shape=(len(x), len(mu)))
+        for x_slice, mu_slice, D in squared_distance_blocks(x, mu, memory_budget):
+            distances[x_slice, mu_slice] = D
+        distances.flush()
+        del distances
+        # rename is atomic : concurrent evaluations never see a partial file
+        os.rename(tmp_path, path)
+    else:
+        print 'Loading the distances from', path
+    return numpy.load(path, mmap_mode='r')
+
+
+def log_likelihoods(x, mu, sigmas, cache_dir=None, memory_budget=MEMORY_BUDGET):
+    """
+    Parzen log-likelihoods of the rows of x for every bandwidth in sigmas, an array of shape (len(sigmas), len(x)).
+    With cache_dir, the distances are read from the cache (see cached_squared_distances).
+    """
+    distances = None
+    if cache_dir:
+        distances = cached_squared_distances(x, mu, cache_dir, memory_budget)
+    return parzen_sweep(x, mu, sigmas, memory_budget, distances)
+
+
+def select_sigma(valid_x, test_x, mu, sigmas, cache_dir=None, memory_budget=MEMORY_BUDGET):
+    """
+    The sigma of the grid with the best mean log-likelihood of valid_x,
+    and the log-likelihoods of the rows of test_x with it (see log_likelihoods).
+    Both sets are evaluated for all the grid with a single pass over the distances.
+    """
+    lls = log_likelihoods(numpy.concatenate([valid_x, test_x]), mu, sigmas, cache_dir, memory_budget)
+    valid_lls = lls[:, :len(valid_x)].mean(1)
+    for sigma, ll in zip(sigmas, valid_lls):
+        print 'sigma = %.4f : mean validation log-likelihood = %.5f' % (sigma, ll)
+    best = numpy.argmax(valid_lls)
+    return sigmas[best], lls[best, len(valid_x):]
+
+
 def get_ll(x, parzen, batch_size=10):
     inds = range(x.shape[0])
     
@@ -73,26 +217,42 @@ def get_ll(x, parzen, batch_size=10):
     return lls
 
 
-def main(sigma, dataset, sample_path='samples.npy'):
+def main(sigma, dataset, sample_path='samples.npy', cache_dir=None, data_path='.'):
+    """
+    Mean log-likelihood of the test set under the Parzen windows centered on the samples.
+    sigma is the bandwidth, or a list of bandwidths among which the best one is chosen on the validation set.
+    With cache_dir, the distances are kept there for the next evaluations of the same samples.
+    The dataset is read from data_path.
+    """
     
     # provide a .npy file where 10k generated samples are saved. 
     filename = sample_path
     
     print 'loading samples from %s'%filename
   
-    (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_mnist('.')
+    (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_mnist(data_path)
     
     samples = numpy.load(filename)
     
-    parzen = theano_parzen(samples, sigma)
+    if not numpy.isscalar(sigma):
+        sigma, test_ll = select_sigma(valid_X, test_X, samples, sigma, cache_dir)
+        print "Best sigma on the validation set = %.4f" % sigma
+    elif cache_dir:
+        test_ll = log_likelihoods(test_X, samples, [sigma], cache_dir)[0]
+    else:
+        parzen = blocked_parzen(samples, sigma)
             
-    test_ll = get_ll(test_X, parzen)
+        test_ll = get_ll(test_X, parzen, batch_size=1000)
     
     print "Mean Log-Likelihood of test set = %.5f" % numpy.mean(test_ll)
     print "Std of Mean Log-Likelihood of test set = %.5f" % (numpy.std(test_ll) / 100)
+    return sigma, numpy.mean(test_ll)
 
 
 if __name__ == "__main__":
     # to use it on MNIST: python likelihood_estimation_parzen.py 0.23 MNIST
-    main(float(sys.argv[1]), sys.argv[2])
+    # or, to choose sigma on the validation set: python likelihood_estimation_parzen.py 0.1,0.15,0.2,0.25,0.3 MNIST
+    # an optional third argument is a directory where the distances are cached
+    sigmas = [float(s) for s in sys.argv[1].split(',')]
+    main(sigmas[0] if len(sigmas) == 1 else sigmas, sys.argv[2], cache_dir=sys.argv[3] if len(sys.argv) > 3 else None)
     
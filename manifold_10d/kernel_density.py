@@ -7,6 +7,11 @@ import matplotlib
 import numpy
 import data_tools.data_provider as data_provider
 import cPickle
+try:
+    from scipy.spatial import cKDTree
+    from scipy.sparse import csr_matrix
+except ImportError:
+    cKDTree = None
 rng_numpy = numpy.random.RandomState(1234)
 
 def load_pkl(path):
@@ -54,8 +59,29 @@ def get_toy_manifold_dataset(n_dim=10):
     test_y = numpy.zeros((test_x.shape[0],)).astype('int32')
     return train_x, train_y, valid_x, valid_y, test_x, test_y
 
+def squared_distances(x, y):
+    # between the rows of x (or a single row) and the rows of y, as ||x||^2 - 2 x.y + ||y||^2
+    x = numpy.asarray(x, dtype='float64')
+    y = numpy.asarray(y, dtype='float64')
+    d = numpy.dot(x, y.T)
+    d *= -2
+    d += (x**2).sum(axis=-1)[..., None]
+    d += (y**2).sum(axis=1)
+    return numpy.maximum(d, 0, out=d)
+
+def log_sum_exp(a):
+    # over the last axis
+    max_ = a.max(axis=-1)
+    return max_ + numpy.log(numpy.exp(a - max_[..., None]).sum(axis=-1))
+
+def segment_log_sum_exp(a, starts):
+    # over the segments of a flat array that begin at starts (non-empty, in increasing order)
+    max_ = numpy.maximum.reduceat(a, starts)
+    segment = numpy.repeat(numpy.arange(len(starts)), numpy.diff(numpy.append(starts, len(a))))
+    return max_ + numpy.log(numpy.add.reduceat(numpy.exp(a - max_[segment]), starts))
+
 class DenoisingParzenWindow(object):
-    def __init__(self):
+    def __init__(self, tolerance=None):
         self.load_dataset()
         self.n_dim = self.train_x.shape[1]
 
@@ -67,74 +93,163 @@ class DenoisingParzenWindow(object):
         self.train_x_noisy = self.sample_z_given_x(self.train_x)
         self.valid_x_noisy = self.sample_z_given_x(self.valid_x)
         self.test_x_noisy = self.sample_z_given_x(self.test_x)
+
+        # With tolerance, a KD-tree over train_x_noisy gives the components near z (see ball_log_p_component),
+        # and the other ones, whose weights add up to less than tolerance, are left out.
+        self.tolerance = tolerance
+        self.index = None
+        if tolerance:
+            if cKDTree is None:
+                print 'scipy is not available : using all the components'
+            else:
+                self.index = cKDTree(self.train_x_noisy)
         
     def load_dataset(self):
         (self.train_x,_,
          self.valid_x,_, self.test_x,_) = get_toy_manifold_dataset(n_dim=10)
     
     def sample_z_given_x(self, x):
-        mu = numpy.zeros((self.n_dim,))
-        cov = numpy.identity(self.n_dim) * (self.gamma**2)
-        if x.ndim == 1:
-            size = 1
-            
-        else:
-            size = x.shape[0]
-            
-        noise = rng_numpy.multivariate_normal(mean=mu, cov=cov, size=size)
-        if size == 1:
-            noise = noise.flatten()
+        # isotropic gaussian noise of std gamma, for one row or a matrix of rows
+        noise = rng_numpy.normal(scale=self.gamma, size=x.shape)
         return x+noise
 
-    def predict(self, D):
+    def predict(self, D, block_size=1000):
+        # Negative log-likelihood of every row of D given a noisy version of it, and their sum.
+        # The rows are evaluated block_size at a time against all the components, in log space.
         D_noisy = self.sample_z_given_x(D)
-        nll = []
-        for d, d_noisy in zip(D, D_noisy):
-            p_d_given_z = self.p_x_given_z(d, d_noisy)
-            nll.append(-numpy.log(p_d_given_z))
+        nll = numpy.empty(D.shape[0])
+        for i in range(0, D.shape[0], block_size):
+            if self.index is not None:
+                rows, which_component, log_p, log_p_gaussian, starts = self.ball_log_p(D[i:i+block_size], D_noisy[i:i+block_size])
+                nll[i:i+block_size] = -segment_log_sum_exp(log_p + log_p_gaussian, starts)
+            else:
+                log_p = self.log_p_component(D_noisy[i:i+block_size])
+                log_p += self.log_p_gaussian_term(D[i:i+block_size])
+                nll[i:i+block_size] = -log_sum_exp(log_p)
 
-        nll = nll.sum()
-        return nll
+        return nll, nll.sum()
         
     def sample_x_given_z(self, z):
-        p_component = self.get_p_component(z)
-        which_component = numpy.argmax(rng_numpy.multinomial(1, p_component, size=1))
+        # for one row or a matrix of rows (one per chain)
+        if self.index is not None:
+            # categorical draw of one of the components of every row, from the cumulative probabilities
+            # of all the rows : the probabilities of every row add up to 1
+            rows, candidates, log_p, starts = self.ball_log_p_component(numpy.atleast_2d(z))
+            cumulative = numpy.exp(log_p).cumsum()
+            u = rng_numpy.uniform(size=len(starts))
+            ends = numpy.append(starts[1:], len(candidates))
+            chosen = numpy.minimum(numpy.searchsorted(cumulative, numpy.arange(len(starts)) + u), ends - 1)
+            which_component = candidates[numpy.maximum(chosen, starts)]
+        else:
+            p_component = self.get_p_component(numpy.atleast_2d(z))
+            # categorical draw of one component per row, from the cumulative probabilities
+            u = rng_numpy.uniform(size=(p_component.shape[0], 1))
+            which_component = numpy.minimum((p_component.cumsum(axis=1) < u).sum(axis=1), p_component.shape[1] - 1)
         mu = self.train_x[which_component]
-        cov = numpy.identity(self.n_dim) * self.sigma**2
-        x = rng_numpy.multivariate_normal(mean=mu, cov=cov, size=1)
-        return x.flatten()
+        x = mu + rng_numpy.normal(scale=self.sigma, size=mu.shape)
+        return x.reshape(z.shape)
         
     def get_p_component(self, x_noisy):
-        w_up = numpy.exp(-((x_noisy - self.train_x_noisy)**2).sum(axis=1) / (2 * self.sigma**2))
-        w_down = numpy.exp(-((x_noisy - self.train_x_noisy)**2).sum(axis=1) / (2 * self.sigma**2)).sum()
-        p_component = w_up / w_down
+        # for one row, or a matrix of rows : one row of probabilities each
+        # the weights are computed once, relative to the largest one so that they do not all underflow
+        # With the index, a sparse matrix with one row per row of x_noisy, zero outside of the near components
+        if self.index is not None:
+            rows, which_component, log_p, starts = self.ball_log_p_component(numpy.atleast_2d(x_noisy))
+            return csr_matrix((numpy.exp(log_p), (rows, which_component)), shape=(len(starts), self.train_x_noisy.shape[0]))
+        return numpy.exp(self.log_p_component(x_noisy))
 
-        return p_component
+    def log_p_component(self, x_noisy):
+        log_w = squared_distances(x_noisy, self.train_x_noisy)
+        log_w *= -1. / (2 * self.sigma**2)
+        log_w -= log_sum_exp(log_w)[..., None]
+        return log_w
+
+    def ball_log_p_component(self, x_noisy, slack=0):
+        # For a matrix of rows, the components within sqrt(d_0^2 + 2 sigma^2 (log(n / tolerance) + slack)) of every row,
+        # from the index, d_0 the distance of the nearest one and n the number of components.
+        # Each of the others weighs less than tolerance / n times the nearest one, so they weigh less than
+        # tolerance together, relative to the kept ones. slack (one per row, or a number) widens the balls.
+        # Returns (rows, which_component, log_p, starts) : the row and the component of every pair,
+        # grouped by row, their log-probabilities, normalized over the pairs of the row,
+        # and the index of the first pair of every row.
+        n = self.train_x_noisy.shape[0]
+        d_0 = self.index.query(x_noisy, k=1)[0]
+        radius = numpy.sqrt(d_0**2 + 2 * self.sigma**2 * (numpy.log(n / self.tolerance) + slack))
+        which_component = [self.index.query_ball_point(z, r) for z, r in zip(x_noisy, radius)]
+        lengths = [len(w) for w in which_component]
+        rows = numpy.repeat(numpy.arange(len(x_noisy)), lengths)
+        which_component = numpy.concatenate(which_component).astype('int64')
+        starts = numpy.cumsum([0] + lengths[:-1])
+        log_p = ((x_noisy[rows] - self.train_x_noisy[which_component])**2).sum(axis=1) * (-1. / (2 * self.sigma**2))
+        log_p -= segment_log_sum_exp(log_p, starts)[rows]
+        return rows, which_component, log_p, starts
+
+    def ball_log_p(self, x, x_noisy):
+        # For matrices of rows x and x_noisy : the pairs of the rows and the components of the ball of x_noisy
+        # (see ball_log_p_component), with their log p_component and log gaussian term, and the starts of the rows.
+        # The components out of the ball weigh less than tolerance in p_component, but not always
+        # in the likelihood, when x is far from the means of the kept ones : the ball is widened
+        # by that gap, so that the components left out weigh less than tolerance in the likelihood too.
+        slack = 0
+        for widen in range(2):
+            rows, which_component, log_p, starts = self.ball_log_p_component(x_noisy, slack)
+            log_p_gaussian = self.log_p_gaussian_term(x[rows], which_component)
+            # the gaussian term is at most its value at the mean
+            slack = (numpy.maximum.reduceat(log_p, starts) - numpy.maximum.reduceat(log_p + log_p_gaussian, starts)
+                     - self.n_dim * numpy.log(numpy.sqrt(2*numpy.pi) * self.sigma))
+        return rows, which_component, log_p, log_p_gaussian, starts
+
+    def log_p_gaussian_term(self, x, which_component=None):
+        # log-density of x under the isotropic gaussian of std sigma around every training example,
+        # or around the example of which_component only (one index per row of x)
+        if which_component is not None:
+            log_p = ((x - self.train_x[which_component])**2).sum(axis=1).astype('float64')
+        else:
+            log_p = squared_distances(x, self.train_x)
+        log_p *= -1. / (2 * self.sigma**2)
+        log_p -= self.n_dim * numpy.log(numpy.sqrt(2*numpy.pi) * self.sigma)
+        return log_p
         
     def p_x_given_z(self, x, x_noisy):
-        
+        # With the index, p_component and p_gaussian_term are sparse matrices with one row per row of x,
+        # over the components of the widened balls (see ball_log_p)
+        if self.index is not None:
+            x, x_noisy = numpy.atleast_2d(x), numpy.atleast_2d(x_noisy)
+            rows, which_component, log_p, log_p_gaussian, starts = self.ball_log_p(x, x_noisy)
+            shape = (len(starts), self.train_x_noisy.shape[0])
+            p_component = csr_matrix((numpy.exp(log_p), (rows, which_component)), shape=shape)
+            p_gaussian_term = csr_matrix((numpy.exp(log_p_gaussian), (rows, which_component)), shape=shape)
+            p_all = numpy.exp(segment_log_sum_exp(log_p + log_p_gaussian, starts)).sum()
+            return p_component, p_gaussian_term, p_all
+
         p_component = self.get_p_component(x_noisy)
-        p_gaussian_term = numpy.exp(
-            -((x - self.train_x)**2).sum(axis=1) / (2 * self.sigma**2)) \
-            / (numpy.sqrt(2*numpy.pi) * self.sigma)
+        p_gaussian_term = numpy.exp(self.log_p_gaussian_term(x))
 
         p_all = (p_component * p_gaussian_term).sum()
         
         return p_component, p_gaussian_term, p_all
         
     
-def gibbs(steps, model):
+def gibbs(steps, model, n_chains=1, burn_in=1000, thin=1):
+    # n_chains chains of steps steps, advanced together, started from the first training examples.
+    # The first burn_in steps are discarded, then one step out of thin is kept.
+    # Returns the kept samples of all the chains, step after step.
+    if steps <= burn_in:
+        raise ValueError('gibbs needs more steps (%d) than burn-in steps (%d)' % (steps, burn_in))
+    if thin < 1 or n_chains < 1:
+        raise ValueError('gibbs needs thin >= 1 and n_chains >= 1, not %d and %d' % (thin, n_chains))
     # initial x
-    x = model.train_x[0]
+    x = model.train_x[numpy.arange(n_chains) % model.train_x.shape[0]]
 
     # sampling
     collection = []
     for i in range(steps):
         z = model.sample_z_given_x(x)
         x = model.sample_x_given_z(z)
-        collection.append(x)
+        if i >= burn_in and (i - burn_in) % thin == 0:
+            collection.append(x)
 
-    return numpy.asarray(collection[1000:])
+    return numpy.vstack(collection)
 
 def plot(sample, data, gamma=None):
     font = {'family' : 'normal',
@@ -169,9 +284,12 @@ def plot(sample, data, gamma=None):
 if __name__ == '__main__':
     i = DenoisingParzenWindow()
     i.load_dataset()
+    # one chain, the first 1000 steps discarded
     n_gibbs_steps = i.train_x.shape[0]
     X = gibbs(n_gibbs_steps, i)
     #plot(X, i.train_x, i.gamma)
     plot_manifold_samples(X, i.train_x, 'test_samples.png')
+    print 'valid NLL per example : %f'%(i.predict(i.valid_x)[1] / i.valid_x.shape[0])
+    print 'test NLL per example : %f'%(i.predict(i.test_x)[1] / i.test_x.shape[0])
 
     
@@ -0,0 +1,38 @@
+"""
+Checks of the KD-tree path of DenoisingParzenWindow against the exact one.
+Run from manifold_10d/ (the datasets are read from the current directory) :
+
+    python -m unittest test_kernel_density
+"""
+import copy
+import unittest
+import numpy
+import kernel_density
+
+class TestIndexedParzenWindow(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        kernel_density.rng_numpy.seed(1)
+        cls.indexed = kernel_density.DenoisingParzenWindow(tolerance=1e-8)
+        # the same noisy training set, without the index
+        cls.exact = copy.copy(cls.indexed)
+        cls.exact.index = None
+
+    def test_p_x_given_z_far_from_the_components(self):
+        # the noisy rows are about gamma * sqrt(n_dim) away from the rows : the components near them
+        # have small gaussian terms, and components of negligible weight can dominate the likelihood
+        for x, x_noisy in zip(self.exact.valid_x[:20], self.exact.valid_x_noisy[:20]):
+            exact = self.exact.p_x_given_z(x, x_noisy)[2]
+            indexed = self.indexed.p_x_given_z(x, x_noisy)[2]
+            self.assertGreater(exact, 0)
+            self.assertAlmostEqual(numpy.log(indexed), numpy.log(exact), delta=1e-4)
+
+    def test_predict(self):
+        kernel_density.rng_numpy.seed(2)
+        exact = self.exact.predict(self.exact.valid_x[:500])[0]
+        kernel_density.rng_numpy.seed(2)
+        indexed = self.indexed.predict(self.exact.valid_x[:500])[0]
+        numpy.testing.assert_allclose(indexed, exact, atol=1e-3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+""" Timing and metrics of the training loop of model.py.
+
+Metrics records, for every epoch, the wall time of each phase of the loop,
+the latencies of the calls of the compiled functions, and values such as
+the costs. They are written as one JSON line per epoch, to metrics.jsonl in
+the directory of the run.
+
+Summary of a run, or comparison of a run with a baseline run :
+
+    python metrics.py metrics.jsonl
+    python metrics.py metrics.jsonl ../baseline/metrics.jsonl
+
+"""
+import json
+import sys
+import time
+import numpy
+from collections import OrderedDict
+from contextlib import contextmanager
+
+def latency_stats(latencies):
+    # Count, total and percentiles of a list of call durations, in seconds
+    latencies   =   numpy.asarray(latencies)
+    return OrderedDict([('count', len(latencies)), ('total', float(latencies.sum())), ('mean', float(latencies.mean())),
+                        ('p50', float(numpy.percentile(latencies, 50))), ('p90', float(numpy.percentile(latencies, 90))),
+                        ('p99', float(numpy.percentile(latencies, 99))), ('max', float(latencies.max()))])
+
+def json_value(value):
+    # nan and inf are not JSON
+    if isinstance(value, (float, numpy.floating)):
+        return float(value) if numpy.isfinite(value) else None
+    return value
+
+class Metrics(object):
+    '''
+    Collects the metrics of an epoch, and writes them as a JSON line to path at end_epoch.
+
+    phase(name) times a block of code, timed(name, function) times every call of function,
+    and record(name=value, ...) keeps values. With append, path is continued (resumed training).
+    '''
+    def __init__(self, path, append=False):
+        self.file   =   open(path, 'a' if append else 'w')
+        self.reset()
+
+    def reset(self):
+        self.phases =   OrderedDict()
+        self.calls  =   OrderedDict()
+        self.values =   OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        start   =   time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        self.phases[name]   =   self.phases.get(name, 0.) + seconds
+
+    def timed(self, name, function):
+        # function, with the duration of every call recorded under name
+        def timed_function(*args, **kwargs):
+            start   =   time.time()
+            result  =   function(*args, **kwargs)
+            self.calls.setdefault(name, []).append(time.time() - start)
+            return result
+        return timed_function
+
+    def record(self, **values):
+        self.values.update(values)
+
+    def end_epoch(self, epoch):
+        # Write the metrics collected since the last call, for epoch (a number, or a name such as 'end')
+        line    =   OrderedDict([('epoch', epoch), ('phases', self.phases),
+                                 ('calls', OrderedDict((name, latency_stats(l)) for name, l in self.calls.items()))])
+        line.update((name, json_value(value)) for name, value in self.values.items())
+        self.file.write(json.dumps(line) + '\n')
+        self.file.flush()
+        self.reset()
+
+    def close(self):
+        self.file.close()
+
+def read_metrics(path):
+    return [json.loads(line, object_pairs_hook=OrderedDict) for line in open(path) if line.strip()]
+
+def summarize(records):
+    # Mean seconds per epoch of every phase of the numbered epochs, seconds of the phases after training,
+    # median over the epochs of the call latencies, and latencies of the calls after training.
+    # The file is continued by --resume and --test_model : an epoch trained again after a resume counts once
+    # (its last record), and the phases and calls after training are those of the last run.
+    last    =   OrderedDict()
+    for r in records:
+        if isinstance(r['epoch'], int):
+            last[r['epoch']]    =   r
+    epochs  =   [last[epoch] for epoch in sorted(last)]
+    ends    =   [r for r in records if not isinstance(r['epoch'], int)]
+    end     =   ends[-1] if ends else {'phases' : {}, 'calls' : {}}
+    phases  =   OrderedDict()
+    for r in epochs:
+        for name in r['phases']:
+            phases[name]    =   sum(e['phases'].get(name, 0.) for e in epochs) / len(epochs)
+    end_phases  =   OrderedDict(end['phases'])
+    calls   =   OrderedDict()
+    for r in epochs:
+        for name in r['calls']:
+            stats   =   [e['calls'][name] for e in epochs if name in e['calls']]
+            calls[name] =   OrderedDict([('count', sum(s['count'] for s in stats))] +
+                                        [(p, float(numpy.median([s[p] for s in stats]))) for p in ['p50', 'p90', 'p99']])
+    end_calls   =   OrderedDict(end['calls'])
+    return phases, end_phases, calls, end_calls
+
+def report(records, baseline=None, threshold=0.1, min_seconds=0.005):
+    # Text report of the phases and calls of records, with the relative change from the baseline records if given.
+    # Changes slower by more than threshold (relative) and than min_seconds are marked.
+    phases, end_phases, calls, end_calls    =   summarize(records)
+    base_phases, base_end_phases, base_calls, base_end_calls    =   summarize(baseline) if baseline else ({}, {}, {}, {})
+    def change(current, base):
+        if not base:
+            return ''
+        relative    =   current / base - 1
+        return '%+7.1f%%' % (100 * relative) + ('  <- slower' if relative > threshold and current - base > min_seconds else '')
+
+    lines   =   []
+    for title, current_phases, base in [('phase (s / epoch)', phases, base_phases), ('after training (s)', end_phases, base_end_phases)]:
+        lines.append('%-24s %12s %12s' % (title, 'current', 'baseline' if baseline else ''))
+        for name in list(current_phases) + [name for name in base if name not in current_phases]:
+            current, base_seconds   =   current_phases.get(name, 0.), base.get(name)
+            lines.append('%-24s %12.4f %12s %s' % (name, current, '%.4f' % base_seconds if base_seconds is not None else '',
+                                                  change(current, base_seconds)))
+        lines.append('')
+    for title, current_calls, base in [('call latency (ms)', calls, base_calls), ('after training (ms)', end_calls, base_end_calls)]:
+        lines.append('%-24s %10s %10s %10s %10s %12s' % (title, 'count', 'p50', 'p90', 'p99', 'baseline p50' if baseline else ''))
+        for name, stats in current_calls.items():
+            base_p50    =   base.get(name, {}).get('p50')
+            lines.append('%-24s %10d %10.3f %10.3f %10.3f %12s %s' % (name, stats['count'], 1000 * stats['p50'], 1000 * stats['p90'],
+                                                                      1000 * stats['p99'], '%.3f' % (1000 * base_p50) if base_p50 is not None else '',
+                                                                      change(stats['p50'], base_p50)))
+        lines.append('')
+    return '\n'.join(lines[:-1])
+
+if __name__ == '__main__':
+    # python metrics.py metrics.jsonl [baseline_metrics.jsonl]
+    print report(read_metrics(sys.argv[1]), read_metrics(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -1,10 +1,13 @@
-import numpy, os, sys, cPickle
+import numpy, os, sys, cPickle, hashlib, itertools, shutil, re, json
 import theano
 import theano.tensor as T
 import theano.sandbox.rng_mrg as RNG_MRG
 import PIL.Image
 from collections import OrderedDict
 from image_tiler import *
+from data_pipeline import training_chunks, Prefetcher, PackedRows, pack_rows, unpack_rows
+from data_parallel import DataParallelTrainer
+from metrics import Metrics, read_metrics, report
 import time
 import argparse
 
@@ -39,163 +42,328 @@ def get_shared_bias(n, name, offset = 0):
     return val
 
 def load_mnist(path):
-    data = cPickle.load(open(os.path.join(path,'mnist.pkl'), 'rb'))
-    return data
-
-def load_mnist_binary(path):
-    data = cPickle.load(open(os.path.join(path,'mnist.pkl'), 'rb'))
-    data = [list(d) for d in data] 
-    data[0][0] = (data[0][0] > 0.5).astype('float32')
-    data[1][0] = (data[1][0] > 0.5).astype('float32')
-    data[2][0] = (data[2][0] > 0.5).astype('float32')
-    data = tuple([tuple(d) for d in data])
-    return data
+    return cached_dataset(path, 'mnist', ['mnist.pkl'], lambda: cPickle.load(open(os.path.join(path,'mnist.pkl'), 'rb')))
+
+def load_mnist_binary(path, packed=False):
+    # The binarized pixels are cached bit-packed, 8 per byte (see data_pipeline.pack_rows).
+    # With packed, the rows are returned as PackedRows, which are only unpacked when indexed.
+    def binarize():
+        data = load_mnist(path)
+        return tuple([(pack_rows(X), Y) for X, Y in data])
+    data = cached_dataset(path, 'mnist_binary_packed', ['mnist.pkl'], binarize)
+    if packed:
+        return tuple([(PackedRows(X, 28*28), Y) for X, Y in data])
+    return tuple([(unpack_rows(X, 28*28), Y) for X, Y in data])
     
 def load_tfd(path):
-    import scipy.io as io
-    data = io.loadmat(os.path.join(path, 'TFD_48x48.mat'))
-    X = cast32(data['images'])/cast32(255)
-    X = X.reshape((X.shape[0], X.shape[1] * X.shape[2]))
-    labels  = data['labs_ex'].flatten()
-    labeled = labels != -1
-    unlabeled   =   labels == -1  
-    train_X =   X[unlabeled]
-    valid_X =   X[unlabeled][:100] # Stuf
-    test_X  =   X[labeled]
-
-    del data
-
-    return (train_X, labels[unlabeled]), (valid_X, labels[unlabeled][:100]), (test_X, labels[labeled])
-
-def experiment(state, channel):
-    if state.test_model and 'config' in os.listdir('.'):
-        print 'Loading local config file'
-        config_file =   open('config', 'r')
-        config      =   config_file.readlines()
-        try:
-            config_vals =   config[0].split('(')[1:][0].split(')')[:-1][0].split(', ')
-        except:
-            config_vals =   config[0][3:-1].replace(': ','=').replace("'","").split(', ')
-            config_vals =   filter(lambda x:not 'jobman' in x and not '/' in x and not ':' in x and not 'experiment' in x, config_vals)
-        
-        for CV in config_vals:
-            print CV
-            if CV.startswith('test'):
-                print 'Do not override testing switch'
-                continue        
-            try:
-                exec('state.'+CV) in globals(), locals()
-            except:
-                exec('state.'+CV.split('=')[0]+"='"+CV.split('=')[1]+"'") in globals(), locals()
-
-    else:
-        # Save the current configuration
-        # Useful for logs/experiments
-        print 'Saving config'
-        f = open('config', 'w')
-        f.write(str(state))
+    def convert():
+        import scipy.io as io
+        data = io.loadmat(os.path.join(path, 'TFD_48x48.mat'))
+        X = cast32(data['images'])/cast32(255)
+        X = X.reshape((X.shape[0], X.shape[1] * X.shape[2]))
+        labels  = data['labs_ex'].flatten()
+        labeled = labels != -1
+        unlabeled   =   labels == -1  
+        train_X =   X[unlabeled]
+        valid_X =   train_X[:100] # Stuf
+        test_X  =   X[labeled]
+
+        del data
+
+        return (train_X, labels[unlabeled]), (valid_X, labels[unlabeled][:100]), (test_X, labels[labeled])
+    return cached_dataset(path, 'tfd', ['TFD_48x48.mat'], convert)
+
+def save_npy_dataset(path, data, names=('train', 'valid', 'test')):
+    # Save the splits returned by a loader as .npy files, to be memory-mapped by load_npy_dataset.
+    # Bit-packed rows (uint8) are kept as they are, the others are saved in float32.
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, (X, Y) in zip(names, data):
+        numpy.save(os.path.join(path, name + '_X.npy'), X if X.dtype == numpy.uint8 else cast32(X))
+        numpy.save(os.path.join(path, name + '_Y.npy'), numpy.asarray(Y))
+
+def load_npy_dataset(path, names=('train', 'valid', 'test')):
+    # Read-only memory maps of the splits saved by save_npy_dataset : rows are only read from disk when used
+    data = []
+    for name in names:
+        X = numpy.load(os.path.join(path, name + '_X.npy'), mmap_mode='r')
+        Y = numpy.load(os.path.join(path, name + '_Y.npy'), mmap_mode='r')
+        data.append((X, Y))
+    return tuple(data)
+
+def cached_dataset(path, name, source_files, loader, names=('train', 'valid', 'test')):
+    # The splits returned by loader(), converted once into .npy files in path/npy_cache/name
+    # (see save_npy_dataset), and memory-mapped from there. A manifest records the sizes and
+    # modification times of the source files of path : the conversion runs again when one changes.
+    # Concurrent jobs share the pages of the files. If the cache cannot be written, loader() is returned.
+    # Every version of the sources has its own directory, named by the hash of the manifest, which is
+    # written elsewhere and renamed into place once complete : a finished cache is never replaced or
+    # deleted, as other jobs may have it memory-mapped. When jobs convert the same version at once,
+    # the first rename wins and the others use its files.
+    manifest    =   {'names' : list(names), 'sources' : dict((f, [os.path.getsize(os.path.join(path, f)), os.path.getmtime(os.path.join(path, f))])
+                                                          for f in source_files)}
+    cache_path  =   os.path.join(path, 'npy_cache', name, hashlib.md5(json.dumps(manifest, sort_keys=True)).hexdigest())
+    try:
+        with open(os.path.join(cache_path, 'manifest.json')) as f:
+            if json.load(f) == manifest:
+                return load_npy_dataset(cache_path, names)
+    except (IOError, ValueError):
+        pass
+
+    data        =   loader()
+    tmp_path    =   cache_path + '.tmp_' + str(os.getpid())
+    try:
+        print 'Caching the dataset in', cache_path
+        save_npy_dataset(tmp_path, data, names)
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        if not os.path.isdir(cache_path):
+            os.rename(tmp_path, cache_path)
+    except (IOError, OSError), e:
+        if not os.path.isdir(cache_path):
+            print 'Could not cache the dataset :', e
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return data
+        # another job renamed its copy first
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    return load_npy_dataset(cache_path, names)
+
+# Bump when the functions built by GSN.build_functions change, to invalidate the cached ones
+FUNCTIONS_VERSION   =   3
+
+def compiled_functions_key(state, N_input):
+    # Hash of everything the compiled graphs depend on, parameter values excluded
+    # (with --scan, N is only the value of GSN.n_walkbacks)
+    config = [('K', state.K), ('N', None if state.scan else state.N), ('act', state.act), ('N_input', N_input), ('hidden_size', state.hidden_size),
+              ('batch_size', state.batch_size), ('hidden_add_noise_sigma', state.hidden_add_noise_sigma),
+              ('input_salt_and_pepper', state.input_salt_and_pepper), ('noiseless_h1', state.noiseless_h1),
+              ('input_sampling', state.input_sampling), ('floatX', theano.config.floatX), ('device', theano.config.device),
+              ('mode', str(theano.config.mode)), ('theano', theano.__version__), ('functions', FUNCTIONS_VERSION),
+              ('data_parallel', state.n_workers > 1), ('scan', state.scan)]
+    return hashlib.md5(repr(config)).hexdigest()
+
+# The graphs of the scan loops (--scan) are too deep for the default recursion limit of cPickle
+PICKLE_RECURSION_LIMIT  =   10000
+
+def save_compiled_functions(path, functions, shared):
+    # The shared variables are pickled together with the functions so that they stay bound to them.
+    # Their values are not needed in the cache : they are emptied while pickling.
+    values = [(s, s.get_value(borrow=True)) for s in shared['weights_list'] + shared['bias_list'] + shared['gradient_buffer'] + [shared['train_X'], shared['valid_X'], shared['test_X']]]
+    for s, v in values:
+        s.set_value(numpy.zeros((0,) * v.ndim, dtype=v.dtype), borrow=True)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # theano.function decides this at compile time, it is not kept by the pickled functions
+    check_aliasing = dict((name, getattr(fn, '_check_for_aliased_inputs', True)) for name, fn in functions.items())
+    tmp_path = path + '.' + str(os.getpid())
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), PICKLE_RECURSION_LIMIT))
+    f = open(tmp_path, 'wb')
+    try:
+        cPickle.dump((functions, shared, check_aliasing), f, protocol=cPickle.HIGHEST_PROTOCOL)
+    finally:
         f.close()
-
-    print state
-    # Load the data, train = train+valid, and shuffle train
-    # Targets are not used (will be misaligned after shuffling train
-    if state.dataset == 'MNIST':
-        (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_mnist(state.data_path)
-        train_X = numpy.concatenate((train_X, valid_X))
-        
-    elif state.dataset == 'MNIST_binary':
-        (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_mnist_binary(state.data_path)
-        train_X = numpy.concatenate((train_X, valid_X))
-        
-    elif state.dataset == 'TFD':
-        (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_tfd(state.data_path)
-    
-    N_input =   train_X.shape[1]
-    root_N_input = numpy.sqrt(N_input)
-    numpy.random.seed(1)
-    numpy.random.shuffle(train_X)
-    train_X = theano.shared(train_X)
-    valid_X = theano.shared(valid_X)
-    test_X  = theano.shared(test_X)
-
-    # Theano variables and RNG
-    X       = T.fmatrix()   # Input of the graph
-    index   = T.lscalar()   # index to minibatch
-    MRG = RNG_MRG.MRG_RandomStreams(1)
-    
-    # Network and training specifications
-    K               =   state.K # number of hidden layers
-    N               =   state.N # number of walkbacks 
-    layer_sizes     =   [N_input] + [state.hidden_size] * K # layer sizes, from h0 to hK (h0 is the visible layer)
-    learning_rate   =   theano.shared(cast32(state.learning_rate))  # learning rate
-    annealing       =   cast32(state.annealing) # exponential annealing coefficient
-    momentum        =   theano.shared(cast32(state.momentum)) # momentum term
-
-
-    # PARAMETERS : weights list and bias list.
-    # initialize a list of weights and biases based on layer_sizes
-    weights_list    =   [get_shared_weights(layer_sizes[i], layer_sizes[i+1], numpy.sqrt(6. / (layer_sizes[i] + layer_sizes[i+1] )), 'W') for i in range(K)]
-    bias_list       =   [get_shared_bias(layer_sizes[i], 'b') for i in range(K + 1)]
-
-    if state.test_model:
-        # Load the parameters of the last epoch
-        # maybe if the path is given, load these specific attributes 
-        param_files     =   filter(lambda x:'params' in x, os.listdir('.'))
-        max_epoch_idx   =   numpy.argmax([int(x.split('_')[-1].split('.')[0]) for x in param_files])
-        params_to_load  =   param_files[max_epoch_idx]
-        PARAMS = cPickle.load(open(params_to_load,'r'))
-        [p.set_value(lp.get_value(borrow=False)) for lp, p in zip(PARAMS[:len(weights_list)], weights_list)]
-        [p.set_value(lp.get_value(borrow=False)) for lp, p in zip(PARAMS[len(weights_list):], bias_list)]
+        for s, v in values:
+            s.set_value(v, borrow=True)
+    # rename is atomic : concurrent runs never see a partial file
+    os.rename(tmp_path, path)
+
+def load_compiled_functions(path):
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), PICKLE_RECURSION_LIMIT))
+    f = open(path, 'rb')
+    try:
+        functions, shared, check_aliasing = cPickle.load(f)
+    finally:
+        f.close()
+    for name, fn in functions.items():
+        fn._check_for_aliased_inputs = check_aliasing[name]
+    return functions, shared
+
+def save_checkpoint(path, arrays):
+    # Save a dict of arrays as the .npy files of the directory path.
+    # They are written to a temporary directory first, which then replaces path :
+    # an interrupted save never leaves a partial checkpoint.
+    parent      =   os.path.dirname(os.path.abspath(path))
+    tmp_path    =   os.path.join(parent, '.tmp_checkpoint_' + str(os.getpid()))
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, value in arrays.items():
+        numpy.save(os.path.join(tmp_path, name + '.npy'), value)
+    if os.path.isdir(path):
+        old_path    =   os.path.join(parent, '.old_checkpoint_' + str(os.getpid()))
+        os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.rename(tmp_path, path)
+
+def load_checkpoint(path):
+    # The arrays of a checkpoint directory, memory-mapped copy-on-write : they are only read from disk when used
+    return dict((name[:-len('.npy')], numpy.load(os.path.join(path, name), mmap_mode='c'))
+                for name in os.listdir(path) if name.endswith('.npy'))
+
+def archive_checkpoint(checkpoint_path, archive_path, archive='compressed'):
+    # Save the parameters of a checkpoint directory as a compressed .npz archive,
+    # in float16 if archive is 'float16'. It can be loaded by GSN.load, but not resumed from.
+    arrays      =   load_checkpoint(checkpoint_path)
+    dtype       =   'float16' if archive == 'float16' else 'float32'
+    params      =   dict((name, arrays[name].astype(dtype)) for name in arrays if name.startswith('W_') or name.startswith('b_'))
+    tmp_path    =   os.path.join(os.path.dirname(os.path.abspath(archive_path)), '.tmp_archive_' + str(os.getpid()) + '.npz')
+    numpy.savez_compressed(tmp_path, **params)
+    os.rename(tmp_path, archive_path)
+
+def retain_checkpoints(path, valid_costs, keep_last=0, keep_every=0, keep_best=False, archive=''):
+    # Retention policy for the checkpoints params_epoch_N of the directory path, N being the epoch.
+    # The keep_last last ones are kept whole (all of them with 0). Older ones are deleted, except those
+    # of every keep_every epochs, and the one with the best valid cost with keep_best.
+    # These are archived (see archive_checkpoint) if archive is 'compressed' or 'float16'.
+    if not keep_last:
+        return
+    checkpoints =   {}
+    for name in os.listdir(path):
+        match   =   re.match(r'params_epoch_(\d+)(\.npz)?$', name)
+        if match:
+            checkpoints.setdefault(int(match.group(1)), []).append(name)
+    epochs      =   sorted(checkpoints)
+    best_epoch  =   None
+    if keep_best:
+        costs   =   [(valid_costs[e - 1], e) for e in epochs if e <= len(valid_costs) and not numpy.isnan(valid_costs[e - 1])]
+        if costs:
+            best_epoch  =   min(costs)[1]
+    for epoch in epochs[:-keep_last]:
+        keep    =   (keep_every and epoch % keep_every == 0) or epoch == best_epoch
+        for name in checkpoints[epoch]:
+            full_path   =   os.path.join(path, name)
+            if os.path.isdir(full_path):
+                if keep and not archive:
+                    continue
+                if keep:
+                    archive_checkpoint(full_path, full_path + '.npz', archive)
+                shutil.rmtree(full_path)
+            elif not keep:
+                os.remove(full_path)
+
+def save_results(path, results):
+    # results as JSON, written to a temporary file first so that readers never see a partial file
+    tmp_path    =   path + '.tmp_' + str(os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(dict((k, float(v) if isinstance(v, numpy.floating) else v) for k, v in results.items()), f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def latest_params_file(path='.'):
+    # The parameter file with the largest epoch number
+    param_files     =   filter(lambda x:'params' in x, os.listdir(path))
+    max_epoch_idx   =   numpy.argmax([int(x.split('_')[-1].split('.')[0]) for x in param_files])
+    return os.path.join(path, param_files[max_epoch_idx])
+
+class GSN(object):
+    '''
+    Generative Stochastic Network.
+
+    Owns the parameters (weights_list and bias_list) and compiles every function once,
+    so that one model can be trained, sampled, and used for reconstruction and inpainting
+    as many times as needed.
+
+    state       :   the network and training specifications, as given by the run_*.py scripts
+    N_input     :   size of the visible layer
+    '''
+    def __init__(self, state, N_input):
+        self.state          =   state
+        self.N_input        =   N_input
+        self.root_N_input   =   numpy.sqrt(N_input)
+
+        # Theano variables and RNG
+        self.X          =   T.fmatrix()   # Input of the graph
+        self.index      =   T.lscalar()   # index to minibatch
+        self.MRG        =   RNG_MRG.MRG_RandomStreams(1)
+
+        # Network and training specifications
+        self.K              =   state.K # number of hidden layers
+        self.N              =   state.N # number of walkbacks
+        # With state.scan, the walkbacks are a theano.scan loop of n_walkbacks steps, which can be changed without compiling again
+        self.n_walkbacks    =   theano.shared(numpy.int64(state.N))
+        self.batch_size     =   state.batch_size
+        self.layer_sizes    =   [N_input] + [int(state.hidden_size)] * self.K # layer sizes, from h0 to hK (h0 is the visible layer)
+        self.learning_rate  =   theano.shared(cast32(state.learning_rate))  # learning rate
+        self.annealing      =   cast32(state.annealing) # exponential annealing coefficient
+        self.momentum       =   theano.shared(cast32(state.momentum)) # momentum term
+
+        # PARAMETERS : weights list and bias list.
+        # initialize a list of weights and biases based on layer_sizes
+        layer_sizes         =   self.layer_sizes
+        self.weights_list   =   [get_shared_weights(layer_sizes[i], layer_sizes[i+1], numpy.sqrt(6. / (layer_sizes[i] + layer_sizes[i+1] )), 'W') for i in range(self.K)]
+        self.bias_list      =   [get_shared_bias(layer_sizes[i], 'b') for i in range(self.K + 1)]
+
+        # f_learn takes its minibatches from this buffer, see fit
+        self.train_X        =   theano.shared(numpy.zeros((0, N_input), dtype='float32'))
+        # f_valid_cost and f_test_cost take their rows from these buffers, see evaluate
+        self.valid_X        =   theano.shared(numpy.zeros((0, N_input), dtype='float32'))
+        self.test_X         =   theano.shared(numpy.zeros((0, N_input), dtype='float32'))
+        self.eval_batch_size    =   state.eval_batch_size
+
+        self.compile()
+
+    @property
+    def params(self):
+        return self.weights_list + self.bias_list
 
     # Util functions
-    def dropout(IN, p = 0.5):
-        noise   =   MRG.binomial(p = p, n = 1, size = IN.shape, dtype='float32')
+    def dropout(self, IN, p = 0.5):
+        noise   =   self.MRG.binomial(p = p, n = 1, size = IN.shape, dtype='float32')
         OUT     =   (IN * noise) / cast32(p)
         return OUT
 
-    def add_gaussian_noise(IN, std = 1):
+    def add_gaussian_noise(self, IN, std = 1):
         print 'GAUSSIAN NOISE : ', std
-        noise   =   MRG.normal(avg  = 0, std  = std, size = IN.shape, dtype='float32')
+        noise   =   self.MRG.normal(avg  = 0, std  = std, size = IN.shape, dtype='float32')
         OUT     =   IN + noise
         return OUT
 
-    def corrupt_input(IN, p = 0.5):
+    def corrupt_input(self, IN, p = 0.5):
         # salt and pepper? masking?
-        noise   =   MRG.binomial(p = p, n = 1, size = IN.shape, dtype='float32')
+        noise   =   self.MRG.binomial(p = p, n = 1, size = IN.shape, dtype='float32')
         IN      =   IN * noise
         return IN
 
-    def salt_and_pepper(IN, p = 0.2):
+    def salt_and_pepper(self, IN, p = 0.2):
         # salt and pepper noise
         print 'DAE uses salt and pepper noise'
-        a = MRG.binomial(size=IN.shape, n=1,
+        a = self.MRG.binomial(size=IN.shape, n=1,
                               p = 1 - p,
                               dtype='float32')
-        b = MRG.binomial(size=IN.shape, n=1,
+        b = self.MRG.binomial(size=IN.shape, n=1,
                               p = 0.5,
                               dtype='float32')
         c = T.eq(a,0) * b
         return IN * a + c
 
+    def hidden_activation(self, x):
+        if self.state.act == 'sigmoid':
+            return T.nnet.sigmoid(x)
+        elif self.state.act == 'rectifier':
+            return T.maximum(cast32(0), x)
+        elif self.state.act == 'tanh':
+            return T.tanh(x)
+
     # Odd layer update function
     # just a loop over the odd layers
-    def update_odd_layers(hiddens, noisy):
-        for i in range(1, K+1, 2):
+    def update_odd_layers(self, hiddens, noisy):
+        for i in range(1, self.K+1, 2):
             print i
             if noisy:
-                simple_update_layer(hiddens, None, i)
+                self.simple_update_layer(hiddens, None, i)
             else:
-                simple_update_layer(hiddens, None, i, add_noise = False)
+                self.simple_update_layer(hiddens, None, i, add_noise = False)
 
     # Even layer update
     # p_X_chain is given to append the p(X|...) at each update (one update = odd update + even update)
-    def update_even_layers(hiddens, p_X_chain, noisy):
-        for i in range(0, K+1, 2):
+    def update_even_layers(self, hiddens, p_X_chain, noisy):
+        for i in range(0, self.K+1, 2):
             print i
             if noisy:
-                simple_update_layer(hiddens, p_X_chain, i)
+                self.simple_update_layer(hiddens, p_X_chain, i)
             else:
-                simple_update_layer(hiddens, p_X_chain, i, add_noise = False)
+                self.simple_update_layer(hiddens, p_X_chain, i, add_noise = False)
 
     # The layer update function
     # hiddens   :   list containing the symbolic theano variables [visible, hidden1, hidden2, ...]
@@ -204,16 +372,19 @@ def experiment(state, channel):
     #               update_layer will append to this list
     # add_noise     : pre and post activation gaussian noise
 
-    def simple_update_layer(hiddens, p_X_chain, i, add_noise=True):
-        # Compute the dot product, whatever layer
-        post_act_noise  =   0
+    def simple_update_layer(self, hiddens, p_X_chain, i, add_noise=True):
+        state           =   self.state
+        K               =   self.K
+        weights_list    =   self.weights_list
+        bias_list       =   self.bias_list
 
+        # Compute the dot product, whatever layer
         if i == 0:
-            hiddens[i]  =   T.dot(hiddens[i+1], weights_list[i].T) + bias_list[i]           
+            hiddens[i]  =   T.dot(hiddens[i+1], weights_list[i].T) + bias_list[i]
 
         elif i == K:
             hiddens[i]  =   T.dot(hiddens[i-1], weights_list[i-1]) + bias_list[i]
-            
+
         else:
             # next layer        :   layers[i+1], assigned weights : W_i
             # previous layer    :   layers[i-1], assigned weights : W_(i-1)
@@ -224,287 +395,654 @@ def experiment(state, channel):
             print '>>NO noise in first layer'
             add_noise   =   False
 
-        # pre activation noise            
+        # pre activation noise
         if i != 0 and add_noise:
             print 'Adding pre-activation gaussian noise'
-            hiddens[i]  =   add_gaussian_noise(hiddens[i], state.hidden_add_noise_sigma)
-       
+            hiddens[i]  =   self.add_gaussian_noise(hiddens[i], state.hidden_add_noise_sigma)
+
         # ACTIVATION!
         if i == 0:
             print 'Sigmoid units'
             hiddens[i]  =   T.nnet.sigmoid(hiddens[i])
         else:
             print 'Hidden units'
-            hiddens[i]  =   hidden_activation(hiddens[i])
+            hiddens[i]  =   self.hidden_activation(hiddens[i])
 
-        # post activation noise            
+        # post activation noise
         if i != 0 and add_noise:
             print 'Adding post-activation gaussian noise'
-            hiddens[i]  =   add_gaussian_noise(hiddens[i], state.hidden_add_noise_sigma)
+            hiddens[i]  =   self.add_gaussian_noise(hiddens[i], state.hidden_add_noise_sigma)
 
         # build the reconstruction chain
         if i == 0:
             # if input layer -> append p(X|...)
             p_X_chain.append(hiddens[i])
-            
+
             # sample from p(X|...)
             if state.input_sampling:
                 print 'Sampling from input'
-                sampled     =   MRG.binomial(p = hiddens[i], size=hiddens[i].shape, dtype='float32')
+                sampled     =   self.MRG.binomial(p = hiddens[i], size=hiddens[i].shape, dtype='float32')
             else:
                 print '>>NO input sampling'
                 sampled     =   hiddens[i]
             # add noise
-            sampled     =   salt_and_pepper(sampled, state.input_salt_and_pepper)
-            
+            sampled     =   self.salt_and_pepper(sampled, state.input_salt_and_pepper)
+
             # set input layer
             hiddens[i]  =   sampled
 
-    def update_layers(hiddens, p_X_chain, noisy = True):
+    def update_layers(self, hiddens, p_X_chain, noisy = True):
         print 'odd layer update'
-        update_odd_layers(hiddens, noisy)
+        self.update_odd_layers(hiddens, noisy)
         print
         print 'even layer update'
-        update_even_layers(hiddens, p_X_chain, noisy)
+        self.update_even_layers(hiddens, p_X_chain, noisy)
+
+    # The walkback chain : N updates of hiddens (modified inplace), unrolled in the graph,
+    # or with state.scan, one update as the step of a theano.scan loop of n_walkbacks steps.
+    # Returns the p(X|...) of every update (a list, or a tensor of one row per update with scan)
+    # and the updates of the random streams of the loop, to give to theano.function.
+    def walkback(self, hiddens, noisy = True):
+        if not self.state.scan:
+            p_X_chain   =   []
+            for i in range(self.N):
+                self.update_layers(hiddens, p_X_chain, noisy)
+            return p_X_chain, OrderedDict()
+
+        def step(*previous):
+            step_hiddens    =   list(previous)
+            step_p_X        =   []
+            self.update_layers(step_hiddens, step_p_X, noisy)
+            return step_hiddens + step_p_X
+
+        outputs, updates    =   theano.scan(step, outputs_info = hiddens + [None], n_steps = self.n_walkbacks)
+        hiddens[:]  =   [h[-1] for h in outputs[:-1]]
+        return outputs[-1], updates
+
+    def build_functions(self):
+        # Build the graphs and compile every function of the model.
+        # Returns the compiled functions, and the shared variables they were built on.
+        state           =   self.state
+        X               =   self.X
+        index           =   self.index
+        K               =   self.K
+        N               =   self.N
+        weights_list    =   self.weights_list
+        bias_list       =   self.bias_list
+        learning_rate   =   self.learning_rate
+        momentum        =   self.momentum
+
+        ''' F PROP '''
+        if state.act == 'sigmoid':
+            print 'Using sigmoid activation'
+        elif state.act == 'rectifier':
+            print 'Using rectifier activation'
+
+        ''' Corrupt X '''
+        X_corrupt   = self.salt_and_pepper(X, state.input_salt_and_pepper)
+
+        ''' hidden layer init '''
+        hiddens     = [X_corrupt]
+        p_X_chain   = []
+        print "Hidden units initialization"
+        for w,b in zip(weights_list, bias_list[1:]):
+            # init with zeros
+            print "Init hidden units at zero before creating the graph"
+            hiddens.append(T.zeros_like(T.dot(hiddens[-1], w)))
+
+        # The layer update scheme
+        print "Building the graph :", N,"updates", "(scan loop)" if state.scan else ""
+        p_X_chain, walkback_updates =   self.walkback(hiddens)
+
+        # COST AND GRADIENTS
+        print 'Cost w.r.t p(X|...) at every step in the graph'
+        #COST        =   T.mean(T.nnet.binary_crossentropy(reconstruction, X))
+        if state.scan:
+            COST    =   T.mean(T.nnet.binary_crossentropy(p_X_chain, X.dimshuffle('x', 0, 1)), axis = [1, 2])
+        else:
+            COST    =   [T.mean(T.nnet.binary_crossentropy(rX, X)) for rX in p_X_chain]
+        #COST = [T.mean(T.sqr(rX-X)) for rX in p_X_chain]
+        show_COST   =   COST[-1]
+        COST        =   T.sum(COST) if state.scan else numpy.sum(COST)
+        #COST = T.mean(COST)
 
- 
-    ''' F PROP '''
-    if state.act == 'sigmoid':
-        print 'Using sigmoid activation'
-        hidden_activation = T.nnet.sigmoid
-    elif state.act == 'rectifier':
-        print 'Using rectifier activation'
-        hidden_activation = lambda x : T.maximum(cast32(0), x)
-    elif state.act == 'tanh':
-        hidden_activation = lambda x : T.tanh(x)    
-   
-    
-    ''' Corrupt X '''
-    X_corrupt   = salt_and_pepper(X, state.input_salt_and_pepper)
-
-    ''' hidden layer init '''
-    hiddens     = [X_corrupt]
-    p_X_chain   = [] 
-    print "Hidden units initialization"
-    for w,b in zip(weights_list, bias_list[1:]):
-        # init with zeros
-        print "Init hidden units at zero before creating the graph"
-        hiddens.append(T.zeros_like(T.dot(hiddens[-1], w)))
-
-    # The layer update scheme
-    print "Building the graph :", N,"updates"
-    for i in range(N):
-        update_layers(hiddens, p_X_chain)
-    
-    # COST AND GRADIENTS    
-    print 'Cost w.r.t p(X|...) at every step in the graph'
-    #COST        =   T.mean(T.nnet.binary_crossentropy(reconstruction, X))
-    COST        =   [T.mean(T.nnet.binary_crossentropy(rX, X)) for rX in p_X_chain]
-    #COST = [T.mean(T.sqr(rX-X)) for rX in p_X_chain]
-    show_COST   =   COST[-1] 
-    COST        =   numpy.sum(COST)
-    #COST = T.mean(COST)
-    
-    params          =   weights_list + bias_list
-    
-    gradient        =   T.grad(COST, params)
-                
-    gradient_buffer =   [theano.shared(numpy.zeros(x.get_value().shape, dtype='float32')) for x in params]
-    
-    m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
-    g_updates       =   [(p, p - learning_rate * mg) for (p, mg) in zip(params, m_gradient)]
-    b_updates       =   zip(gradient_buffer, m_gradient)
-        
-    updates         =   OrderedDict(g_updates + b_updates)
-    
-    f_cost      =   theano.function(inputs = [X], outputs = show_COST)
-    
-    indexed_batch   = train_X[index * state.batch_size : (index+1) * state.batch_size]
-    sampled_batch   = MRG.binomial(p = indexed_batch, size = indexed_batch.shape, dtype='float32')
-    
-    f_learn     =   theano.function(inputs  = [index], 
-                                    updates = updates, 
-                                    givens  = {X : indexed_batch},
-                                    outputs = show_COST)
-    
-    f_test      =   theano.function(inputs  =   [X],
-                                    outputs =   [X_corrupt] + hiddens[0] + p_X_chain,
-                                    on_unused_input = 'warn')
+        params          =   weights_list + bias_list
 
+        gradient        =   T.grad(COST, params)
 
-    #############
-    # Denoise some numbers  :   show number, noisy number, reconstructed number
-    #############
-    import random as R
-    R.seed(1)
-    random_idx      =   numpy.array(R.sample(range(len(test_X.get_value())), 100))
-    numbers         =   test_X.get_value()[random_idx]
-    
-    f_noise = theano.function(inputs = [X], outputs = salt_and_pepper(X, state.input_salt_and_pepper))
-    noisy_numbers   =   f_noise(test_X.get_value()[random_idx])
+        gradient_buffer =   [theano.shared(numpy.zeros(x.get_value().shape, dtype='float32')) for x in params]
+
+        m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
+        g_updates       =   [(p, p - learning_rate * mg) for (p, mg) in zip(params, m_gradient)]
+        b_updates       =   zip(gradient_buffer, m_gradient)
+
+        updates         =   OrderedDict(g_updates + b_updates)
+        # the random streams of a scan loop
+        updates.update(walkback_updates)
+
+        f_cost      =   theano.function(inputs = [X], outputs = show_COST, updates = walkback_updates)
+
+        if state.n_workers > 1:
+            # Data-parallel training (see data_parallel.py) : the workers compute the gradients of their rows
+            # with f_grad, and f_apply makes the momentum update of f_learn with their mean
+            f_grad          =   theano.function(inputs = [X], outputs = [show_COST] + gradient, updates = walkback_updates)
+            mean_gradient   =   [p.type() for p in params]
+            m_mean_gradient =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, mean_gradient)]
+            f_apply         =   theano.function(inputs = mean_gradient,
+                                                updates = OrderedDict([(p, p - learning_rate * mg) for (p, mg) in zip(params, m_mean_gradient)] +
+                                                                      zip(gradient_buffer, m_mean_gradient)))
+
+        # Cost of rows of the evaluation buffers, gathered by index in the graph
+        rows            =   T.lvector()
+        f_valid_cost    =   theano.function(inputs = [rows], givens = {X : self.valid_X[rows]}, outputs = show_COST, updates = walkback_updates)
+        f_test_cost     =   theano.function(inputs = [rows], givens = {X : self.test_X[rows]}, outputs = show_COST, updates = walkback_updates)
+
+        indexed_batch   = self.train_X[index * state.batch_size : (index+1) * state.batch_size]
+        sampled_batch   = self.MRG.binomial(p = indexed_batch, size = indexed_batch.shape, dtype='float32')
+
+        f_learn     =   theano.function(inputs  = [index],
+                                        updates = updates,
+                                        givens  = {X : indexed_batch},
+                                        outputs = show_COST)
+
+        f_test      =   theano.function(inputs  =   [X],
+                                        outputs =   [X_corrupt, hiddens[0], p_X_chain] if state.scan else [X_corrupt] + hiddens[0] + p_X_chain,
+                                        updates =   walkback_updates,
+                                        on_unused_input = 'warn')
+
+        f_noise = theano.function(inputs = [X], outputs = self.salt_and_pepper(X, state.input_salt_and_pepper))
+
+        # Recompile the graph without noise for reconstruction function
+        hiddens_R     = [X]
+
+        for w,b in zip(weights_list, bias_list[1:]):
+            # init with zeros
+            hiddens_R.append(T.zeros_like(T.dot(hiddens_R[-1], w)))
+
+        # The layer update scheme
+        p_X_chain_R, recon_updates  =   self.walkback(hiddens_R, noisy=False)
+
+        f_recon = theano.function(inputs = [X], outputs = p_X_chain_R[-1], updates = recon_updates)
 
-    # Recompile the graph without noise for reconstruction function
-    hiddens_R     = [X]
-    p_X_chain_R   = []
 
-    for w,b in zip(weights_list, bias_list[1:]):
-        # init with zeros
-        hiddens_R.append(T.zeros_like(T.dot(hiddens_R[-1], w)))
+        ############
+        # Sampling #
+        ############
 
-    # The layer update scheme
-    for i in range(N):
-        update_layers(hiddens_R, p_X_chain_R, noisy=False)
+        # the input to the sampling function
+        network_state_input     =   [X] + [T.fmatrix() for i in range(K)]
 
-    f_recon = theano.function(inputs = [X], outputs = p_X_chain_R[-1]) 
+        # "Output" state of the network (noisy)
+        # initialized with input, then we apply updates
+        #network_state_output    =   network_state_input
 
+        network_state_output    =   [X] + network_state_input[1:]
+
+        visible_pX_chain        =   []
+
+        # ONE update
+        self.update_layers(network_state_output, visible_pX_chain, noisy=True)
+
+        if K == 1:
+            f_sample_simple = theano.function(inputs = [X], outputs = visible_pX_chain[-1])
+
+
+        # WHY IS THERE A WARNING????
+        # because the first odd layers are not used -> directly computed FROM THE EVEN layers
+        # unused input = warn
+        f_sample2   =   theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+
+        functions   =   OrderedDict([('f_learn', f_learn), ('f_cost', f_cost), ('f_valid_cost', f_valid_cost), ('f_test_cost', f_test_cost),
+                                     ('f_test', f_test), ('f_noise', f_noise),
+                                     ('f_recon', f_recon), ('f_sample2', f_sample2)])
+        if K == 1:
+            functions['f_sample_simple']    =   f_sample_simple
+        if state.n_workers > 1:
+            functions['f_grad']     =   f_grad
+            functions['f_apply']    =   f_apply
+
+        shared      =   {'weights_list' : weights_list, 'bias_list' : bias_list, 'gradient_buffer' : gradient_buffer,
+                         'learning_rate' : learning_rate, 'momentum' : momentum, 'train_X' : self.train_X,
+                         'valid_X' : self.valid_X, 'test_X' : self.test_X, 'n_walkbacks' : self.n_walkbacks,
+                         'random_states' : [update[0] for update in self.MRG.state_updates]}
+
+        return functions, shared
+
+    def compile(self):
+        # Compile the functions, or load them from the on-disk cache (see compiled_functions_key)
+        cache_file  =   None
+        if self.state.function_cache:
+            cache_file  =   os.path.join(theano.config.compiledir, 'gsn_functions', compiled_functions_key(self.state, self.N_input) + '.pkl')
+
+        if cache_file is not None and os.path.isfile(cache_file):
+            print 'Loading compiled functions from', cache_file
+            functions, shared   =   load_compiled_functions(cache_file)
+
+            # The cached functions come with their own shared variables : swap in the current values
+            for cached, current in zip(shared['weights_list'] + shared['bias_list'] + [shared['learning_rate'], shared['momentum'],
+                                       shared['train_X'], shared['valid_X'], shared['test_X']],
+                                       self.params + [self.learning_rate, self.momentum, self.train_X, self.valid_X, self.test_X]):
+                cached.set_value(current.get_value(borrow=True), borrow=True)
+            for gb, current in zip(shared['gradient_buffer'], self.params):
+                gb.set_value(numpy.zeros(current.get_value(borrow=True).shape, dtype='float32'))
+
+            self.weights_list   =   shared['weights_list']
+            self.bias_list      =   shared['bias_list']
+            self.learning_rate  =   shared['learning_rate']
+            self.momentum       =   shared['momentum']
+            self.train_X        =   shared['train_X']
+            self.valid_X        =   shared['valid_X']
+            self.test_X         =   shared['test_X']
+            if 'n_walkbacks' in shared:
+                shared['n_walkbacks'].set_value(self.n_walkbacks.get_value())
+                self.n_walkbacks    =   shared['n_walkbacks']
+        else:
+            functions, shared   =   self.build_functions()
+            if cache_file is not None:
+                print 'Saving compiled functions to', cache_file
+                save_compiled_functions(cache_file, functions, shared)
+
+        self.gradient_buffer    =   shared['gradient_buffer']
+        self.random_states      =   shared['random_states']
+
+        self.f_learn    =   functions['f_learn']
+        self.f_cost     =   functions['f_cost']
+        self.f_valid_cost   =   functions['f_valid_cost']
+        self.f_test_cost    =   functions['f_test_cost']
+        self.f_test     =   functions['f_test']
+        self.f_noise    =   functions['f_noise']
+        self.f_recon    =   functions['f_recon']
+        self.f_sample2  =   functions['f_sample2']
+        if self.K == 1:
+            self.f_sample_simple    =   functions['f_sample_simple']
+        if self.state.n_workers > 1:
+            self.f_grad     =   functions['f_grad']
+            self.f_apply    =   functions['f_apply']
 
     ############
-    # Sampling #
+    # Training #
     ############
-    
-    # the input to the sampling function
-    network_state_input     =   [X] + [T.fmatrix() for i in range(K)]
-   
-    # "Output" state of the network (noisy)
-    # initialized with input, then we apply updates
-    #network_state_output    =   network_state_input
-    
-    network_state_output    =   [X] + network_state_input[1:]
-
-    visible_pX_chain        =   []
+    def train_epoch(self, X=None):
+        # One pass of f_learn over the minibatches of the training buffer,
+        # after copying X into it if given. Returns the mean training cost.
+        if X is not None:
+            self.train_X.set_value(cast32(X), borrow=True)
+        train_cost  =   []
+        for i in range(len(self.train_X.get_value(borrow=True)) / self.batch_size):
+            train_cost.append(self.f_learn(i))
+        return numpy.mean(train_cost)
+
+    def train_chunks(self, chunks):
+        # One pass over training rows that do not fit in memory : each chunk is staged
+        # in turn into the training buffer, and f_learn runs over its minibatches.
+        # Returns the mean training cost.
+        train_cost  =   []
+        for chunk in chunks:
+            self.train_X.set_value(chunk, borrow=True)
+            for i in range(len(chunk) / self.batch_size):
+                train_cost.append(self.f_learn(i))
+        return numpy.mean(train_cost)
 
-    # ONE update
-    update_layers(network_state_output, visible_pX_chain, noisy=True)
+    def anneal(self):
+        # ANNEAL!
+        new_lr = self.learning_rate.get_value() * self.annealing
+        self.learning_rate.set_value(new_lr)
+
+    def fit(self, X, n_epoch=1):
+        # Train on X for n_epoch epochs, annealing the learning rate after each one.
+        # Returns the list of mean training costs.
+        self.train_X.set_value(cast32(X), borrow=True)
+        train_costs =   []
+        for epoch in range(n_epoch):
+            train_costs.append(self.train_epoch())
+            self.anneal()
+        return train_costs
+
+    def cost(self, X, batch_size=None):
+        # Mean reconstruction cost of the last walkback step, over batches of X
+        if batch_size is None:
+            batch_size  =   self.batch_size
+        costs   =   [self.f_cost(cast32(X[i : i + batch_size])) for i in range(0, len(X), batch_size)]
+        weights =   [len(X[i : i + batch_size]) for i in range(0, len(X), batch_size)]
+        return numpy.average(costs, weights=weights)
+
+    def evaluate(self, data_set, rows=None, batch_size=None):
+        # Mean cost over rows (all of them by default) of the valid_X or test_X buffer (data_set is 'valid' or 'test').
+        # The rows are selected by index in the compiled function : the data is not copied from the buffer.
+        if data_set == 'valid':
+            f_cost, X   =   self.f_valid_cost, self.valid_X
+        else:
+            f_cost, X   =   self.f_test_cost, self.test_X
+        if rows is None:
+            rows    =   numpy.arange(len(X.get_value(borrow=True)))
+        if batch_size is None:
+            batch_size  =   self.eval_batch_size
+        costs   =   [f_cost(rows[i : i + batch_size]) for i in range(0, len(rows), batch_size)]
+        weights =   [len(rows[i : i + batch_size]) for i in range(0, len(rows), batch_size)]
+        return numpy.average(costs, weights=weights)
+
+    ##################
+    # Reconstruction #
+    ##################
+    def noise(self, X):
+        # Salt and pepper corruption of X
+        return self.f_noise(cast32(X))
+
+    def reconstruct(self, X):
+        # Noiseless walkback from X, returns the last p(X|...)
+        return self.f_recon(cast32(X))
 
-    if K == 1: 
-        f_sample_simple = theano.function(inputs = [X], outputs = visible_pX_chain[-1])
-    
-    
-    # WHY IS THERE A WARNING????
-    # because the first odd layers are not used -> directly computed FROM THE EVEN layers
-    # unused input = warn
-    f_sample2   =   theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+    ############
+    # Sampling #
+    ############
+    def sampling_wrapper(self, NSI):
+        out             =   self.f_sample2(*NSI)
+        NSO             =   out[:self.K + 1]
+        vis_pX_chain    =   out[self.K + 1:]
+        return NSO, vis_pX_chain
 
-    def sample_some_numbers_single_layer():
-        x0    =   test_X.get_value()[:1]
+    def sample_single_layer(self, x0, N=400):
+        # Chain of the one layer model, started from the row x0
         samples = [x0]
-        x  =   f_noise(x0)
-        for i in range(399):
-            x = f_sample_simple(x)
+        x  =   self.f_noise(x0)
+        for i in range(N-1):
+            x = self.f_sample_simple(x)
             samples.append(x)
             x = numpy.random.binomial(n=1, p=x, size=x.shape).astype('float32')
-            x = f_noise(x)
+            x = self.f_noise(x)
         return numpy.vstack(samples)
-            
-    def sampling_wrapper(NSI):
-        out             =   f_sample2(*NSI)
-        NSO             =   out[:len(network_state_output)]
-        vis_pX_chain    =   out[len(network_state_output):]
-        return NSO, vis_pX_chain
 
-    def sample_some_numbers(N=400):
-        # The network's initial state
-        init_vis    =   test_X.get_value()[:1]
+    def sample(self, init_vis, N=400, burn_in=0, thin=1, include_init=False):
+        # One independent chain per row of init_vis, all run as the rows of one batch.
+        # After burn_in steps, every thin-th step contributes len(init_vis) rows,
+        # until N rows have been collected.
+        # With include_init (and no burn_in), the chains start with init_vis itself, as in the plots.
+        # It is left out by default : when the chains start from test rows, samples scored
+        # against the test set must not contain them.
+        # Returns the visible units expectation chain and the noisy h0 chain.
+        init_vis        =   cast32(init_vis)
+        n_chains        =   len(init_vis)
 
-        noisy_init_vis  =   f_noise(init_vis)
+        noisy_init_vis  =   self.f_noise(init_vis)
 
-        network_state   =   [[noisy_init_vis] + [numpy.zeros((1,len(b.get_value())), dtype='float32') for b in bias_list[1:]]]
+        network_state   =   [noisy_init_vis] + [numpy.zeros((n_chains,len(b.get_value())), dtype='float32') for b in self.bias_list[1:]]
 
-        visible_chain   =   [init_vis]
+        visible_chain   =   []
 
-        noisy_h0_chain  =   [noisy_init_vis]
+        noisy_h0_chain  =   []
 
-        for i in range(N-1):
-           
-            # feed the last state into the network, compute new state, and obtain visible units expectation chain 
-            net_state_out, vis_pX_chain =   sampling_wrapper(network_state[-1])
+        if include_init and burn_in == 0:
+            # the initial state is part of the chain
+            visible_chain.append(init_vis)
+            noisy_h0_chain.append(noisy_init_vis)
+
+        n_rows  =   len(visible_chain) * n_chains
+        step    =   0
+
+        while n_rows < N:
+            step += 1
+
+            # feed the last state into the network, compute new state, and obtain visible units expectation chain
+            network_state, vis_pX_chain =   self.sampling_wrapper(network_state)
+
+            if step <= burn_in or (step - burn_in) % thin != 0:
+                continue
 
             # append to the visible chain
             visible_chain   +=  vis_pX_chain
 
-            # append state output to the network state chain
-            network_state.append(net_state_out)
-            
-            noisy_h0_chain.append(net_state_out[0])
+            noisy_h0_chain.append(network_state[0])
+
+            n_rows  +=  n_chains
+
+        return numpy.vstack(visible_chain)[:N], numpy.vstack(noisy_h0_chain)[:N]
 
-        return numpy.vstack(visible_chain), numpy.vstack(noisy_h0_chain)
-    
-    def plot_samples(epoch_number):
-        to_sample = time.time()
-        if K == 1:
-            # one layer model
-            V = sample_some_numbers_single_layer()
-        else:
-            V, H0 = sample_some_numbers()
-        img_samples =   PIL.Image.fromarray(tile_raster_images(V, (root_N_input,root_N_input), (20,20)))
-        
-        fname       =   'samples_epoch_'+str(epoch_number)+'.png'
-        img_samples.save(fname) 
-        print 'Took ' + str(time.time() - to_sample) + ' to sample 400 numbers'
-   
     ##############
     # Inpainting #
     ##############
-    def inpainting(digit):
-        # The network's initial state
+    def inpaint(self, digits, fixed_mask, n_steps=50):
+        # One chain per row of digits, all run as the rows of one batch.
+        # fixed_mask is True where the visible units are clamped to the digit,
+        # either one mask for all the rows or one mask per row.
+        # Returns the visible and noisy h0 chains, of shape (n_steps, len(digits), N_input).
+        digits      =   cast32(digits)
 
         # NOISE INIT
-        init_vis    =   cast32(numpy.random.uniform(size=digit.shape))
-
-        #noisy_init_vis  =   f_noise(init_vis)
-        #noisy_init_vis  =   cast32(numpy.random.uniform(size=init_vis.shape))
-
-        # INDEXES FOR VISIBLE AND NOISY PART
-        noise_idx = (numpy.arange(N_input) % root_N_input < (root_N_input/2))
-        fixed_idx = (numpy.arange(N_input) % root_N_input > (root_N_input/2))
-        # function to re-init the visible to the same noise
+        init_vis    =   cast32(numpy.random.uniform(size=digits.shape))
 
-        # FUNCTION TO RESET HALF VISIBLE TO DIGIT
+        # FUNCTION TO RESET THE FIXED PART OF THE VISIBLE TO THE DIGITS
         def reset_vis(V):
-            V[0][fixed_idx] =   digit[0][fixed_idx]
-            return V
-        
-        # INIT DIGIT : NOISE and RESET HALF TO DIGIT
+            return numpy.where(fixed_mask, digits, V)
+
+        # INIT DIGITS : NOISE and RESET FIXED PART TO DIGITS
         init_vis = reset_vis(init_vis)
 
-        network_state   =   [[init_vis] + [numpy.zeros((1,len(b.get_value())), dtype='float32') for b in bias_list[1:]]]
+        network_state   =   [init_vis] + [numpy.zeros((len(digits),len(b.get_value())), dtype='float32') for b in self.bias_list[1:]]
 
         visible_chain   =   [init_vis]
 
         noisy_h0_chain  =   [init_vis]
 
-        for i in range(49):
-           
-            # feed the last state into the network, compute new state, and obtain visible units expectation chain 
-            net_state_out, vis_pX_chain =   sampling_wrapper(network_state[-1])
+        for i in range(n_steps - 1):
 
+            # feed the last state into the network, compute new state, and obtain visible units expectation chain
+            network_state, vis_pX_chain =   self.sampling_wrapper(network_state)
 
-            # reset half the digit
-            net_state_out[0] = reset_vis(net_state_out[0])
-            vis_pX_chain[0]  = reset_vis(vis_pX_chain[0])
+            # reset the fixed part of the digits
+            network_state[0]    =   reset_vis(network_state[0])
+            vis_pX_chain[0]     =   reset_vis(vis_pX_chain[0])
 
             # append to the visible chain
             visible_chain   +=  vis_pX_chain
 
-            # append state output to the network state chain
-            network_state.append(net_state_out)
-            
-            noisy_h0_chain.append(net_state_out[0])
+            noisy_h0_chain.append(network_state[0])
+
+        return numpy.asarray(visible_chain), numpy.asarray(noisy_h0_chain)
+
+    ##############
+    # Parameters #
+    ##############
+    def named_state(self):
+        # Everything training depends on, by name : the parameters, the momentum buffers,
+        # the learning rate and momentum, and the states of the random streams of the graph
+        return ([('W_%d' % i, W) for i, W in enumerate(self.weights_list)] +
+                [('b_%d' % i, b) for i, b in enumerate(self.bias_list)] +
+                [('gradient_buffer_%d' % i, gb) for i, gb in enumerate(self.gradient_buffer)] +
+                [('learning_rate', self.learning_rate), ('momentum', self.momentum)] +
+                [('random_state_%d' % i, rstate) for i, rstate in enumerate(self.random_states)])
+
+    def save(self, save_path, extra={}):
+        # Checkpoint directory of .npy files (see save_checkpoint) with the training state,
+        # and the arrays of extra
+        arrays  =   OrderedDict([(name, s.get_value(borrow=True)) for name, s in self.named_state()])
+        arrays.update(extra)
+        save_checkpoint(save_path, arrays)
+
+    def load(self, params_file):
+        # Restore a checkpoint directory, the parameters of an archive (see archive_checkpoint),
+        # or the parameters of a pickled list (older format).
+        # Returns the arrays of the checkpoint, including the extra ones given to save.
+        if params_file.endswith('.npz'):
+            arrays  =   numpy.load(params_file)
+            for name, s in self.named_state():
+                if name in arrays.files:
+                    s.set_value(numpy.asarray(arrays[name], dtype='float32'))
+            return {}
+        if not os.path.isdir(params_file):
+            PARAMS = cPickle.load(open(params_file,'r'))
+            [p.set_value(lp.get_value(borrow=False)) for lp, p in zip(PARAMS[:len(self.weights_list)], self.weights_list)]
+            [p.set_value(lp.get_value(borrow=False)) for lp, p in zip(PARAMS[len(self.weights_list):], self.bias_list)]
+            return {}
+        arrays  =   load_checkpoint(params_file)
+        for name, s in self.named_state():
+            if name in arrays:
+                s.set_value(arrays[name], borrow=True)
+        return arrays
+
+def experiment(state, channel=None):
+    if state.test_model and 'config' in os.listdir('.'):
+        print 'Loading local config file'
+        config_file =   open('config', 'r')
+        config      =   config_file.readlines()
+        try:
+            config_vals =   config[0].split('(')[1:][0].split(')')[:-1][0].split(', ')
+        except:
+            config_vals =   config[0][3:-1].replace(': ','=').replace("'","").split(', ')
+            config_vals =   filter(lambda x:not 'jobman' in x and not '/' in x and not ':' in x and not 'experiment' in x, config_vals)
+        
+        for CV in config_vals:
+            print CV
+            if CV.startswith('test'):
+                print 'Do not override testing switch'
+                continue        
+            try:
+                exec('state.'+CV) in globals(), locals()
+            except:
+                exec('state.'+CV.split('=')[0]+"='"+CV.split('=')[1]+"'") in globals(), locals()
+
+    else:
+        # Save the current configuration
+        # Useful for logs/experiments
+        print 'Saving config'
+        f = open('config', 'w')
+        f.write(str(state))
+        f.close()
+
+    print state
+    # Load the data, train = train+valid, and shuffle train
+    # Targets are not used (will be misaligned after shuffling train
+    if state.memmap_path:
+        # Out-of-core training : the splits stay on disk (see save_npy_dataset),
+        # and the training rows are read in chunks at every epoch
+        print 'Memory-mapping the dataset from', state.memmap_path
+        (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_npy_dataset(state.memmap_path)
+        valid_rows  =   valid_X
+        if train_X.dtype == numpy.uint8:
+            # bit-packed rows (the MNIST_binary cache) : the training rows are unpacked chunk by chunk
+            train_X     =   PackedRows(train_X, 28*28)
+            valid_rows  =   PackedRows(valid_X, 28*28)
+            valid_X     =   unpack_rows(valid_X, 28*28)
+            test_X      =   unpack_rows(test_X, 28*28)
+        if state.dataset in ['MNIST', 'MNIST_binary']:
+            train_sets = [train_X, valid_rows]
+        else:
+            train_sets = [train_X]
 
-        return numpy.vstack(visible_chain), numpy.vstack(noisy_h0_chain)
+    elif state.dataset == 'MNIST':
+        (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_mnist(state.data_path)
+        train_X = numpy.concatenate((train_X, valid_X))
+        
+    elif state.dataset == 'MNIST_binary':
+        (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_mnist_binary(state.data_path, state.pack_binary)
+        if state.pack_binary:
+            # The training rows stay packed 8 pixels per byte, and are unpacked chunk by chunk
+            # by the input pipeline. The valid and test sets are evaluated from float32 buffers.
+            train_X = PackedRows(numpy.concatenate((train_X.bits, valid_X.bits)), train_X.n_dim)
+            valid_X = valid_X[:]
+            test_X  = test_X[:]
+        else:
+            train_X = numpy.concatenate((train_X, valid_X))
+        
+    elif state.dataset == 'TFD':
+        (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_tfd(state.data_path)
     
-  
-  
-   
+    N_input =   train_X.shape[1]
+    root_N_input = numpy.sqrt(N_input)
+    numpy.random.seed(1)
+    if not state.memmap_path:
+        # same order as numpy.random.shuffle, which cannot shuffle the read-only memory maps of the dataset cache
+        permutation =   numpy.random.permutation(len(train_X))
+        if isinstance(train_X, PackedRows):
+            train_X =   train_X.subset(permutation)
+        else:
+            train_X =   train_X[permutation]
+
+    gsn     =   GSN(state, N_input)
+    # Training rows that are prepared again at every epoch (read from disk, reshuffled or binarized)
+    # go through the input pipeline, in chunks staged into the training buffer.
+    use_pipeline    =   state.memmap_path or state.reshuffle or state.binarize_input or isinstance(train_X, PackedRows) or state.n_workers > 1
+    if not state.memmap_path:
+        if use_pipeline:
+            train_sets = [train_X]
+        else:
+            gsn.train_X.set_value(train_X, borrow=True)
+            train_sets = [gsn.train_X.get_value(borrow=True)]
+    # whole minibatches only (of n_workers * batch_size rows in data-parallel training)
+    step_rows   =   state.batch_size * state.n_workers
+    chunk_size  =   max(state.train_chunk_size / step_rows, 1) * step_rows
+    gsn.valid_X.set_value(numpy.asarray(valid_X, dtype='float32'), borrow=True)
+    gsn.test_X.set_value(numpy.asarray(test_X, dtype='float32'), borrow=True)
+    valid_X =   gsn.valid_X
+    test_X  =   gsn.test_X
+
+    K               =   state.K # number of hidden layers
+    weights_list    =   gsn.weights_list
+    bias_list       =   gsn.bias_list
+
+    if state.test_model:
+        # Load the parameters of the last epoch
+        # maybe if the path is given, load these specific attributes 
+        gsn.load(latest_params_file('.'))
+
+    # Wall time of the phases of every epoch and latencies of the compiled functions, in metrics.jsonl
+    metrics     =   Metrics('metrics.jsonl', append=state.resume or state.test_model)
+    for name in ['f_learn', 'f_valid_cost', 'f_test_cost', 'f_recon', 'f_sample2', 'f_apply']:
+        if hasattr(gsn, name):
+            setattr(gsn, name, metrics.timed(name, getattr(gsn, name)))
+    writer_times    =   dict(image_writer().times)
+    def end_epoch(epoch):
+        # with the time spent since the last record on the pictures written in the background
+        for name, seconds in image_writer().times.items():
+            metrics.add_time(name + ' (background)', seconds - writer_times[name])
+            writer_times[name]  =   seconds
+        metrics.end_epoch(epoch)
+
+    f_cost      =   gsn.f_cost
+    f_recon     =   gsn.f_recon
+
+
+    #############
+    # Denoise some numbers  :   show number, noisy number, reconstructed number
+    #############
+    import random as R
+    R.seed(1)
+    random_idx      =   numpy.array(R.sample(range(len(test_X.get_value())), 100))
+    numbers         =   test_X.get_value()[random_idx]
+    noisy_numbers   =   gsn.noise(test_X.get_value()[random_idx])
+
+
+    def sample_some_numbers_single_layer():
+        x0    =   test_X.get_value()[:1]
+        return gsn.sample_single_layer(x0)
+
+    def sample_some_numbers(N=400, n_chains=1, burn_in=0, thin=1, include_init=False):
+        # n_chains independent chains, started from the first n_chains test examples.
+        # With the defaults and include_init, this is the single consecutive chain of the plots.
+        # The samples of the parzen estimate never include these test examples.
+        n_test      =   len(test_X.get_value(borrow=True))
+        init_vis    =   test_X.get_value(borrow=True)[numpy.arange(n_chains) % n_test]
+        return gsn.sample(init_vis, N, burn_in, thin, include_init)
     
-    def save_params(n, params):
+    def plot_samples(epoch_number):
+        to_sample = time.time()
+        if K == 1:
+            # one layer model
+            V = sample_some_numbers_single_layer()
+        else:
+            V, H0 = sample_some_numbers(include_init=True)
+        # tiled and saved in the background
+        fname       =   'samples_epoch_'+str(epoch_number)+'.png'
+        image_writer().save_tiles(fname, V, (root_N_input,root_N_input), (20,20))
+        print 'Took ' + str(time.time() - to_sample) + ' to sample 400 numbers'
+   
+    def save_params(n):
+        # with the state of the training loop, for --resume
         print 'saving parameters...'
-        save_path = 'params_epoch_'+str(n)+'.pkl'
-        f = open(save_path, 'wb')
-        try:
-            cPickle.dump(params, f, protocol=cPickle.HIGHEST_PROTOCOL)
-        finally:
-            f.close() 
+        save_path = 'params_epoch_'+str(n)
+        numpy_rng = numpy.random.get_state()
+        gsn.save(save_path, {'epoch' : numpy.asarray(n), 'train_costs' : numpy.asarray(train_costs, dtype='float64'),
+                             'valid_costs' : numpy.asarray(valid_costs, dtype='float64'), 'test_costs' : numpy.asarray(test_costs, dtype='float64'),
+                             'numpy_rng_keys' : numpy_rng[1], 'numpy_rng_state' : numpy.asarray(numpy_rng[2:], dtype='float64')})
 
     # TRAINING
     n_epoch     =   state.n_epoch
@@ -517,50 +1055,97 @@ def experiment(state, channel):
     test_costs  =   []
     
     if state.vis_init:
-        bias_list[0].set_value(logit(numpy.clip(0.9,0.001,train_X.get_value().mean(axis=0))))
+        train_mean  =   sum(X.sum(axis=0) for X in train_sets) / cast32(sum(len(X) for X in train_sets))
+        bias_list[0].set_value(logit(numpy.clip(0.9,0.001,train_mean)))
 
     if state.test_model:
         # If testing, do not train and go directly to generating samples, parzen window estimation, and inpainting
         print 'Testing : skip training'
         STOP    =   True
 
-
+    elif state.resume and filter(lambda x:'params' in x, os.listdir('.')):
+        # Continue training from the last checkpoint, as if it had not stopped
+        params_file =   latest_params_file('.')
+        print 'Resuming from', params_file
+        checkpoint  =   gsn.load(params_file)
+        if 'epoch' in checkpoint:
+            counter     =   int(checkpoint['epoch'])
+            train_costs =   list(checkpoint['train_costs'])
+            valid_costs =   list(checkpoint['valid_costs'])
+            test_costs  =   list(checkpoint['test_costs'])
+            pos, has_gauss, cached_gaussian =   checkpoint['numpy_rng_state']
+            numpy.random.set_state(('MT19937', numpy.array(checkpoint['numpy_rng_keys']), int(pos), int(has_gauss), cached_gaussian))
+        else:
+            print 'No training state in', params_file, ': only the parameters are restored'
+        STOP    =   counter >= n_epoch
+
+    # Evaluation during training : a fixed random subset of eval_subset rows (all of them with 0).
+    # The costs after the last epoch are over the whole sets.
+    subset_rng  =   numpy.random.RandomState(1)
+    valid_rows  =   None
+    test_rows   =   None
+    if state.eval_subset:
+        valid_rows  =   numpy.sort(subset_rng.permutation(len(valid_X.get_value(borrow=True)))[:state.eval_subset])
+        test_rows   =   numpy.sort(subset_rng.permutation(len(test_X.get_value(borrow=True)))[:state.eval_subset])
+
+    pipeline    =   None
+    if use_pipeline and not STOP:
+        # Chunks for all the remaining epochs. They have their own random numbers, so that
+        # the data order does not depend on what else draws from numpy.random.
+        chunks          =   training_chunks(train_sets, chunk_size, range(counter + 1, n_epoch + 1), 1,
+                                            state.memmap_path or state.reshuffle, state.binarize_input)
+        if state.prefetch:
+            # prepared in the background while f_learn runs, including during validation and plotting
+            pipeline        =   Prefetcher(chunks, chunk_size, N_input)
+            chunks          =   iter(pipeline)
+
+    trainer     =   gsn
+    if state.n_workers > 1 and not STOP:
+        # minibatches of n_workers * batch_size rows, split between as many processes
+        print 'Training with', state.n_workers, 'worker processes'
+        trainer     =   DataParallelTrainer(gsn, state.n_workers, chunk_size)
+
+    training_start  =   time.time()
     while not STOP:
         counter     +=  1
         t = time.time()
         print counter,'\t',
 
         #train
-        train_cost  =   []
-        for i in range(len(train_X.get_value(borrow=True)) / batch_size):
-            #train_cost.append(f_learn(train_X[i * batch_size : (i+1) * batch_size]))
-            #training_idx = numpy.array(range(i*batch_size, (i+1)*batch_size), dtype='int32')
-            train_cost.append(f_learn(i))
-        train_cost = numpy.mean(train_cost) 
+        with metrics.phase('train'):
+            if use_pipeline:
+                # the chunks of one epoch, up to its end marker
+                train_cost  =   trainer.train_chunks(itertools.takewhile(lambda chunk: chunk is not None, chunks))
+            else:
+                train_cost  =   gsn.train_epoch()
         train_costs.append(train_cost)
         print 'Train : ',trunc(train_cost), '\t',
 
 
+        if counter >= n_epoch:
+            STOP = True
+
+        # valid and test costs every eval_every epochs, and always after the last one (nan when skipped)
+        evaluate    =   (counter % state.eval_every) == 0 or STOP
+
         #valid
-        valid_cost  =   []
-        for i in range(len(valid_X.get_value(borrow=True)) / 100):
-            valid_cost.append(f_cost(valid_X.get_value()[i * 100 : (i+1) * batch_size]))
-        valid_cost = numpy.mean(valid_cost)
-        #valid_cost  =   123
+        if evaluate:
+            with metrics.phase('valid'):
+                valid_cost  =   gsn.evaluate('valid', None if STOP else valid_rows)
+        else:
+            valid_cost  =   numpy.nan
         valid_costs.append(valid_cost)
         print 'Valid : ', trunc(valid_cost), '\t',
 
         #test
-        test_cost  =   []
-        for i in range(len(test_X.get_value(borrow=True)) / 100):
-            test_cost.append(f_cost(test_X.get_value()[i * 100 : (i+1) * batch_size]))
-        test_cost = numpy.mean(test_cost)
+        if evaluate:
+            with metrics.phase('test'):
+                test_cost   =   gsn.evaluate('test', None if STOP else test_rows)
+        else:
+            test_cost   =   numpy.nan
         test_costs.append(test_cost)
         print 'Test  : ', trunc(test_cost), '\t',
 
-        if counter >= n_epoch:
-            STOP = True
-
         print 'time : ', trunc(time.time() - t),
 
         print 'MeanVisB : ', trunc(bias_list[0].get_value().mean()),
@@ -568,24 +1153,36 @@ def experiment(state, channel):
         print 'W : ', [trunc(abs(w.get_value(borrow=True)).mean()) for w in weights_list]
 
         if (counter % 5) == 0:
-            # Checking reconstruction
-            reconstructed   =   f_recon(noisy_numbers) 
-            # Concatenate stuff
-            stacked         =   numpy.vstack([numpy.vstack([numbers[i*10 : (i+1)*10], noisy_numbers[i*10 : (i+1)*10], reconstructed[i*10 : (i+1)*10]]) for i in range(10)])
-        
-            number_reconstruction   =   PIL.Image.fromarray(tile_raster_images(stacked, (root_N_input,root_N_input), (10,30)))
-            #epoch_number    =   reduce(lambda x,y : x + y, ['_'] * (4-len(str(counter)))) + str(counter)
-            number_reconstruction.save('number_reconstruction'+str(counter)+'.png')
+            with metrics.phase('recon'):
+                # Checking reconstruction
+                reconstructed   =   f_recon(noisy_numbers) 
+                # Concatenate stuff
+                stacked         =   numpy.vstack([numpy.vstack([numbers[i*10 : (i+1)*10], noisy_numbers[i*10 : (i+1)*10], reconstructed[i*10 : (i+1)*10]]) for i in range(10)])
+            
+                #epoch_number    =   reduce(lambda x,y : x + y, ['_'] * (4-len(str(counter)))) + str(counter)
+                image_writer().save_tiles('number_reconstruction'+str(counter)+'.png', stacked, (root_N_input,root_N_input), (10,30))
     
             #sample_numbers(counter, 'seven')
-            plot_samples(counter)
-    
-            #save params
-            save_params(counter, params)
+            with metrics.phase('plot_samples'):
+                plot_samples(counter)
      
         # ANNEAL!
-        new_lr = learning_rate.get_value() * annealing
-        learning_rate.set_value(new_lr)
+        gsn.anneal()
+
+        if (counter % 5) == 0:
+            #save params, after annealing so that training continues from them
+            with metrics.phase('save_params'):
+                save_params(counter)
+                retain_checkpoints('.', valid_costs, state.keep_last, state.keep_every, state.keep_best, state.archive)
+
+        metrics.record(train_cost=train_cost, valid_cost=valid_cost, test_cost=test_cost, epoch_time=time.time() - t)
+        end_epoch(counter)
+
+    if pipeline is not None:
+        pipeline.close()
+    if trainer is not gsn:
+        trainer.close()
+    training_time   =   time.time() - training_start
 
     # Save
     state.train_costs = train_costs
@@ -596,7 +1193,10 @@ def experiment(state, channel):
 
     # 10k samples
     print 'Generating 10,000 samples'
-    samples, _  =   sample_some_numbers(N=10000)
+    t = time.time()
+    with metrics.phase('sample_10k'):
+        samples, _  =   sample_some_numbers(N=10000, n_chains=state.n_chains, burn_in=state.burn_in, thin=state.thin)
+    print 'Took ' + str(time.time() - t) + ' to sample 10,000 numbers with ' + str(state.n_chains) + ' chains'
     f_samples   =   'samples.npy'
     numpy.save(f_samples, samples)
     print 'saved digits'
@@ -605,7 +1205,22 @@ def experiment(state, channel):
     # parzen
     print 'Evaluating parzen window'
     import likelihood_estimation_parzen
-    likelihood_estimation_parzen.main(0.20,'mnist') 
+    sigmas  =   [float(s) for s in state.parzen_sigmas.split(',')]
+    with metrics.phase('parzen'):
+        sigma, log_likelihood   =   likelihood_estimation_parzen.main(sigmas[0] if len(sigmas) == 1 else sigmas, 'mnist',
+                                                                      cache_dir=state.parzen_cache or None,
+                                                                      data_path=state.data_path)
+
+    if not state.test_model:
+        # the final numbers of the run, collected by run_sweep.py
+        valid       =   numpy.asarray(valid_costs, dtype='float64')
+        best_epoch  =   int(numpy.nanargmin(valid)) + 1 if len(valid) and not numpy.isnan(valid).all() else 0
+        save_results('results.json', {'epochs' : counter, 'train_cost' : train_costs[-1] if train_costs else None,
+                                      'valid_cost' : valid_costs[-1] if valid_costs else None,
+                                      'test_cost' : test_costs[-1] if test_costs else None,
+                                      'best_valid_cost' : valid_costs[best_epoch - 1] if best_epoch else None, 'best_epoch' : best_epoch,
+                                      'parzen_sigma' : sigma, 'parzen_log_likelihood' : log_likelihood,
+                                      'training_time' : training_time})
 
     # Inpainting
     print 'Inpainting'
@@ -614,6 +1229,9 @@ def experiment(state, channel):
     numpy.random.seed(2)
     test_idx    =   numpy.arange(len(test_Y))
 
+    # INDEXES FOR THE FIXED HALF OF THE VISIBLE
+    fixed_idx = (numpy.arange(N_input) % root_N_input > (root_N_input/2))
+
     for Iter in range(10):
 
         numpy.random.shuffle(test_idx)
@@ -621,25 +1239,29 @@ def experiment(state, channel):
         test_Y = test_Y[test_idx]
 
         digit_idx = [(test_Y==i).argmax() for i in range(10)]
-        inpaint_list = []
-
-        for idx in digit_idx:
-            DIGIT = test_X[idx:idx+1]
-            V_inpaint, H_inpaint = inpainting(DIGIT)
-            inpaint_list.append(V_inpaint)
-
-        INPAINTING  =   numpy.vstack(inpaint_list)
 
-        plot_inpainting =   PIL.Image.fromarray(tile_raster_images(INPAINTING, (root_N_input,root_N_input), (10,50)))
+        # one chain per digit, each row of the picture is one chain
+        with metrics.phase('inpaint'):
+            V_inpaint, H_inpaint = gsn.inpaint(test_X[digit_idx], fixed_idx)
+        INPAINTING  =   V_inpaint.transpose(1, 0, 2).reshape((-1, N_input))
 
         fname   =   'inpainting_'+str(Iter)+'.png'
         #fname   =   os.path.join(state.model_path, fname)
 
-        plot_inpainting.save(fname)
+        image_writer().save_tiles(fname, INPAINTING, (root_N_input,root_N_input), (10,50))
 
         if False and __name__ ==  "__main__":
             os.system('eog inpainting.png')
  
+    # wait for the pictures still being written
+    with metrics.phase('image_flush'):
+        image_writer().flush()
+
+    # the phases after training, and the report of the run (compared to --metrics_baseline)
+    metrics.record(parzen_log_likelihood=log_likelihood)
+    end_epoch('end')
+    metrics.close()
+    print report(read_metrics('metrics.jsonl'), read_metrics(state.metrics_baseline) if state.metrics_baseline else None)
 
 
 
@@ -5,7 +5,7 @@ and inpaint MNIST dataset based on those.
 
 """
 
-import numpy, os, sys, cPickle
+import numpy, os, sys, cPickle, itertools
 import theano
 import theano.tensor as T
 import theano.sandbox.rng_mrg as RNG_MRG
@@ -17,6 +17,8 @@ import argparse
 from scipy.misc import imsave
 from os.path import join
 import progressbar
+from model import load_mnist, load_mnist_binary, load_tfd, cached_dataset, load_npy_dataset
+from data_pipeline import training_chunks
 
 
 
@@ -84,20 +86,13 @@ def get_shared_bias(n, name, offset = 0):
     val = theano.shared(value = val, name = name)
     return val
 
-def load_mnist(path):
-    data = cPickle.load(open(os.path.join(path,'mnist.pkl'), 'rb'))
-    return data
-
-def load_mnist_binary(path):
-    data = cPickle.load(open(os.path.join(path,'mnist.pkl'), 'rb'))
-    data = [list(d) for d in data] 
-    data[0][0] = (data[0][0] > 0.5).astype('float32')
-    data[1][0] = (data[1][0] > 0.5).astype('float32')
-    data[2][0] = (data[2][0] > 0.5).astype('float32')
-    data = tuple([tuple(d) for d in data])
-    return data
-
 def mnist(data_dir):
+    # converted once, memory-mapped from the dataset cache of model.py
+    files = ['train-images.idx3-ubyte', 'train-labels.idx1-ubyte', 't10k-images.idx3-ubyte', 't10k-labels.idx1-ubyte']
+    (trX, trY), (teX, teY) = cached_dataset(data_dir, 'mnist_idx', files, lambda: _read_mnist_idx(data_dir), names=('train', 'test'))
+    return trX, teX, trY, teY
+
+def _read_mnist_idx(data_dir):
     fd = open(os.path.join(data_dir,'train-images.idx3-ubyte'))
     loaded = numpy.fromfile(file=fd,dtype=numpy.uint8)
     trX = loaded[16:].reshape((60000,28*28)).astype('float32')
@@ -117,7 +112,7 @@ def mnist(data_dir):
     trY = numpy.asarray(trY)
     teY = numpy.asarray(teY)
 
-    return trX, teX, trY, teY
+    return (trX, trY), (teX, teY)
 
 def mnist_with_valid_set(data_dir):
     trX, teX, trY, teY = mnist(data_dir)
@@ -129,38 +124,20 @@ def mnist_with_valid_set(data_dir):
 
     return (trX,trY), (vaX,vaY), (teX,teY)
 
-    
-def load_tfd(path):
-    import scipy.io as io
-    data = io.loadmat(os.path.join(path, 'TFD_48x48.mat'))
-    X = cast32(data['images'])/cast32(255)
-    X = X.reshape((X.shape[0], X.shape[1] * X.shape[2]))
-    labels  = data['labs_ex'].flatten()
-    labeled = labels != -1
-    unlabeled   =   labels == -1  
-    train_X =   X[unlabeled]
-    valid_X =   X[unlabeled][:100] # Stuf
-    test_X  =   X[labeled]
-
-    del data
-
-    return (train_X, labels[unlabeled]), (valid_X, labels[unlabeled][:100]), (test_X, labels[labeled])
 
 def load_norb_small(path):
-    tr_mat_file = os.path.join(path,'smallnorb-5x46789x9x18x6x2x96x96-training-dat.mat')
-    te_mat_file = os.path.join(path,'smallnorb-5x01235x9x18x6x2x96x96-testing-dat.mat')
-    with open(tr_mat_file, 'rb') as f:
-        data = f.read()
-        trX = np.fromstring(b[24:], dtype=np.uint8).reshape((24300,2,96,96))
-        trX = trX.astype('float32') / cast32(255)
-        del data
-    with open(te_mat_file, 'rb') as f:
-        data = f.read()
-        teX = np.fromstring(b[24:], dtype=np.uint8).reshape((24300,2,96,96))
-        teX = teX.astype('float32') / cast32(255)
-        del data
-    Y = np.tile(np.arange(5), (24300 / 5)) # samples arranged by class in cyclic order
-    return  (trX,Y), (teX,Y)
+    tr_mat_file = 'smallnorb-5x46789x9x18x6x2x96x96-training-dat.mat'
+    te_mat_file = 'smallnorb-5x01235x9x18x6x2x96x96-testing-dat.mat'
+    def convert():
+        Y = numpy.tile(numpy.arange(5), (24300 / 5)) # samples arranged by class in cyclic order
+        data = []
+        for mat_file in [tr_mat_file, te_mat_file]:
+            # the images follow a 24 bytes header
+            X = numpy.fromfile(os.path.join(path, mat_file), dtype=numpy.uint8)[24:].reshape((24300,2,96,96))
+            data.append((X.astype('float32') / cast32(255), Y))
+        return data
+    # converted once, memory-mapped from the dataset cache of model.py
+    return cached_dataset(path, 'norb_small', [tr_mat_file, te_mat_file], convert, names=('train', 'test'))
 
 
 def experiment(state, channel):
@@ -194,7 +171,17 @@ def experiment(state, channel):
 
     print state
     # Load the data, train = train+valid
-    if state.dataset == 'MNIST':
+    if state.memmap_path:
+        # Out-of-core training, as in model.experiment : the splits stay on disk (see save_npy_dataset),
+        # and the training rows are read in chunks at every epoch
+        print 'Memory-mapping the dataset from', state.memmap_path
+        (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_npy_dataset(state.memmap_path)
+        if state.dataset in ['MNIST', 'MNIST_binary']:
+            train_sets = [train_X, valid_X]
+        else:
+            train_sets = [train_X]
+
+    elif state.dataset == 'MNIST':
         (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) = load_mnist(state.data_path)
         train_X = numpy.concatenate((train_X, valid_X))
         
@@ -208,8 +195,15 @@ def experiment(state, channel):
     N_input =   train_X.shape[1]
     root_N_input = numpy.sqrt(N_input)
     numpy.random.seed(1)
-    numpy.random.shuffle(train_X)
-    train_X = theano.shared(train_X)
+    if state.memmap_path:
+        # whole minibatches only
+        chunk_size  =   max(state.train_chunk_size / state.batch_size, 1) * state.batch_size
+        # the training buffer indexed by f_learn, into which the chunks are staged
+        train_X = theano.shared(numpy.zeros((chunk_size, N_input), dtype='float32'))
+    else:
+        # same order as numpy.random.shuffle, which cannot shuffle the read-only memory maps of the dataset cache
+        train_X = train_X[numpy.random.permutation(len(train_X))]
+        train_X = theano.shared(train_X)
     valid_X = theano.shared(valid_X)
     test_X  = theano.shared(test_X)
 
@@ -534,70 +528,58 @@ def experiment(state, channel):
             V = sample_some_numbers_single_layer()
         else:
             V, H0 = sample_some_numbers()
-        img_samples =   PIL.Image.fromarray(tile_raster_images(V, (root_N_input,root_N_input), (20,20)))
-        
+        # tiled and saved in the background
         fname       =   'samples_epoch_'+str(epoch_number)+'.png'
-        img_samples.save(fname) 
+        image_writer().save_tiles(fname, V, (root_N_input,root_N_input), (20,20))
         print 'Took ' + str(time.time() - to_sample) + ' to sample 400 numbers'
    
     ##############
     # Inpainting #
     ##############
-    def inpainting(digit, noise_mask):
-        # The network's initial state
+    def inpainting(digits, noise_masks):
+        # digits        :   one image per row
+        # noise_masks   :   one boolean mask per row, True at the missing locations
+        # Every image runs its own chain, as the rows of one batch.
+        # Returns the visible and noisy h0 chains, of shape (50, len(digits), N_input)
 
         # NOISE INIT
-        init_vis    =   cast32(numpy.random.uniform(size=digit.shape))
-        
-
-        #noisy_init_vis  =   f_noise(init_vis)
-        #noisy_init_vis  =   cast32(numpy.random.uniform(size=init_vis.shape))
+        init_vis    =   cast32(numpy.random.uniform(size=digits.shape))
 
 
         # INDEXES FOR VISIBLE AND NOISY PART
 
-        noise_idx = noise_mask
+        noise_idx = noise_masks
         fixed_idx = numpy.logical_not(noise_idx)
 
-        # function to re-init the visible to the same noise
-
-        # FUNCTION TO RESET VISIBLE PART OF DIGIT
+        # FUNCTION TO RESET VISIBLE PART OF DIGITS, row by row
         def reset_vis(V):
-            V[0][fixed_idx] =   digit[0][fixed_idx]
-            return V
+            return numpy.where(fixed_idx, digits, V)
         
-        # INIT DIGIT : NOISE and RESET VISIBLE PART OF DIGIT
+        # INIT DIGITS : NOISE and RESET VISIBLE PART OF DIGITS
         init_vis = reset_vis(init_vis)
 
-        network_state   =   [[init_vis] + [numpy.zeros((1,len(b.get_value())), dtype='float32') for b in bias_list[1:]]]
+        network_state   =   [init_vis] + [numpy.zeros((len(digits),len(b.get_value())), dtype='float32') for b in bias_list[1:]]
 
         visible_chain   =   [init_vis]
 
         noisy_h0_chain  =   [init_vis]
-        start_chain   =   [init_vis]
 
         for i in range(49):
            
             # feed the last state into the network, compute new state, and obtain visible units expectation chain 
-            net_state_out, vis_pX_chain =   sampling_wrapper(network_state[-1])
+            network_state, vis_pX_chain =   sampling_wrapper(network_state)
 
 
-            # reset half the digit
-            net_state_out[0] = reset_vis(net_state_out[0])
+            # reset the visible part of the digits
+            network_state[0] = reset_vis(network_state[0])
             vis_pX_chain[0]  = reset_vis(vis_pX_chain[0])
 
             # append to the visible chain
             visible_chain   +=  vis_pX_chain
 
-            # append state output to the network state chain
-            network_state.append(net_state_out)
-            
-            noisy_h0_chain.append(net_state_out[0])
-        
-        start_chain.append(vis_pX_chain)
-
+            noisy_h0_chain.append(network_state[0])
 
-        return numpy.vstack(visible_chain), numpy.vstack(noisy_h0_chain)
+        return numpy.asarray(visible_chain), numpy.asarray(noisy_h0_chain)
     
   
   
@@ -623,7 +605,11 @@ def experiment(state, channel):
     test_costs  =   []
     
     if state.vis_init:
-        bias_list[0].set_value(logit(numpy.clip(0.9,0.001,train_X.get_value().mean(axis=0))))
+        if state.memmap_path:
+            train_mean  =   sum(X.sum(axis=0) for X in train_sets) / cast32(sum(len(X) for X in train_sets))
+        else:
+            train_mean  =   train_X.get_value().mean(axis=0)
+        bias_list[0].set_value(logit(numpy.clip(0.9,0.001,train_mean)))
 
     if state.test_model:
         # If testing, do not train and go directly to generating samples, parzen window estimation, and inpainting
@@ -638,10 +624,17 @@ def experiment(state, channel):
 
         #train
         train_cost  =   []
-        for i in range(len(train_X.get_value(borrow=True)) / batch_size):
-            #train_cost.append(f_learn(train_X[i * batch_size : (i+1) * batch_size]))
-            #training_idx = numpy.array(range(i*batch_size, (i+1)*batch_size), dtype='int32')
-            train_cost.append(f_learn(i))
+        if state.memmap_path:
+            # the chunks of this epoch, up to its end marker, each staged in turn into the training buffer
+            for chunk in itertools.takewhile(lambda chunk: chunk is not None, training_chunks(train_sets, chunk_size, [counter])):
+                train_X.set_value(chunk, borrow=True)
+                for i in range(len(chunk) / batch_size):
+                    train_cost.append(f_learn(i))
+        else:
+            for i in range(len(train_X.get_value(borrow=True)) / batch_size):
+                #train_cost.append(f_learn(train_X[i * batch_size : (i+1) * batch_size]))
+                #training_idx = numpy.array(range(i*batch_size, (i+1)*batch_size), dtype='int32')
+                train_cost.append(f_learn(i))
         train_cost = numpy.mean(train_cost) 
         train_costs.append(train_cost)
         print 'Train : ',trunc(train_cost), '\t',
@@ -679,9 +672,8 @@ def experiment(state, channel):
             # Concatenate stuff
             stacked         =   numpy.vstack([numpy.vstack([numbers[i*10 : (i+1)*10], noisy_numbers[i*10 : (i+1)*10], reconstructed[i*10 : (i+1)*10]]) for i in range(10)])
         
-            number_reconstruction   =   PIL.Image.fromarray(tile_raster_images(stacked, (root_N_input,root_N_input), (10,30)))
             #epoch_number    =   reduce(lambda x,y : x + y, ['_'] * (4-len(str(counter)))) + str(counter)
-            number_reconstruction.save('number_reconstruction'+str(counter)+'.png')
+            image_writer().save_tiles('number_reconstruction'+str(counter)+'.png', stacked, (root_N_input,root_N_input), (10,30))
     
             #sample_numbers(counter, 'seven')
             plot_samples(counter)
@@ -711,26 +703,26 @@ def experiment(state, channel):
     pbar = progressbar.ProgressBar(widgets=[progressbar.FormatLabel('\rProcessed %(value)d of %(max)d Images '), progressbar.Bar()], maxval=total_images, term_width=50).start()
 
 
-    digit_idx = numpy.arange(total_images)
-    inpaint_list = []
+    batch_size = state.inpaint_batch_size
     if not os.path.exists(save_path):
         os.mkdir(save_path)
     with open(join(save_path,'index.txt'),'wb') as db_file:
 
-        for idx in digit_idx:
-            DIGIT = load_image(os.path.join(md_dir,image_data[idx][0]),1).reshape((1,28*28)).astype('float32') / cast32(255)
-            mask_im=load_image(os.path.join(md_dir,raw_mask_data[idx][0]),1).reshape(28*28).astype('uint8')
-            noise_mask = (mask_im > 0) # since mask is 1 at missing locations
-            V_inpaint, H_inpaint = inpainting(DIGIT,noise_mask)
-            save_name = os.path.basename(image_data[idx][0].replace('corrupted','ip'))
-            full_save_path = os.path.join(save_path, save_name)
-            imsave(full_save_path, V_inpaint[-1].reshape((28,28)),)
-            inpaint_list.append(V_inpaint)
-            db_file.write('%s %s\n' % ( save_name, image_data[idx][1]))
-            pbar.update(idx)
+        for start in range(0, total_images, batch_size):
+            digit_idx = numpy.arange(start, min(start + batch_size, total_images))
+            DIGITS = numpy.vstack([load_image(os.path.join(md_dir,image_data[idx][0]),1).reshape((1,28*28)).astype('float32') / cast32(255) for idx in digit_idx])
+            mask_ims = numpy.vstack([load_image(os.path.join(md_dir,raw_mask_data[idx][0]),1).reshape((1,28*28)).astype('uint8') for idx in digit_idx])
+            noise_masks = (mask_ims > 0) # since mask is 1 at missing locations
+            V_inpaint, H_inpaint = inpainting(DIGITS,noise_masks)
+            for idx, V_last in zip(digit_idx, V_inpaint[-1]):
+                save_name = os.path.basename(image_data[idx][0].replace('corrupted','ip'))
+                full_save_path = os.path.join(save_path, save_name)
+                image_writer().submit(imsave, full_save_path, V_last.reshape((28,28)))
+                db_file.write('%s %s\n' % ( save_name, image_data[idx][1]))
+            pbar.update(digit_idx[-1])
+        # wait for the images still being written
+        image_writer().flush()
         pbar.finish()
 
-        INPAINTING  =   numpy.vstack(inpaint_list)
-
 
     return 
@@ -15,8 +15,12 @@ def main():
     # Add options here
     parser.add_argument('--K', type=int, default=1) 
     parser.add_argument('--N', type=int, default=1) 
+    parser.add_argument('--scan', type=int, default=0) # build the walkbacks as a theano.scan loop : compile time does not grow with N
     parser.add_argument('--n_epoch', type=int, default=200)
     parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--eval_batch_size', type=int, default=1000) # rows per call when computing the valid and test costs
+    parser.add_argument('--eval_every', type=int, default=1) # compute the valid and test costs every eval_every epochs
+    parser.add_argument('--eval_subset', type=int, default=0) # compute them on a fixed random subset of rows during training, 0 for all
     parser.add_argument('--hidden_add_noise_sigma', type=float, default=0)
     parser.add_argument('--input_salt_and_pepper', type=float, default=0.4)
     parser.add_argument('--learning_rate', type=float, default=10)
@@ -26,12 +30,31 @@ def main():
     parser.add_argument('--act', type=str, default='sigmoid')
     parser.add_argument('--dataset', type=str, default='MNIST_binary')
     parser.add_argument('--data_path', type=str, default='.')
+    parser.add_argument('--memmap_path', type=str, default='') # directory of .npy splits, trained on out-of-core
+    parser.add_argument('--train_chunk_size', type=int, default=10000) # training rows in memory at once, with --memmap_path, --reshuffle or --binarize_input
+    parser.add_argument('--reshuffle', type=int, default=0) # reshuffle the training rows at every epoch
+    parser.add_argument('--binarize_input', type=int, default=0) # sample binary training rows at every epoch, with the pixel values as probabilities
+    parser.add_argument('--pack_binary', type=int, default=1) # keep the MNIST_binary training rows packed 8 pixels per byte, unpacked chunk by chunk
+    parser.add_argument('--prefetch', type=int, default=1) # prepare the next training chunks in a background process
+    parser.add_argument('--n_workers', type=int, default=1) # data-parallel training : minibatches of n_workers * batch_size rows, split between as many processes
+    parser.add_argument('--n_chains', type=int, default=1) # number of parallel chains for the 10k samples
+    parser.add_argument('--burn_in', type=int, default=0) # sampling steps discarded before collecting samples
+    parser.add_argument('--thin', type=int, default=1) # keep one sampling step out of thin
+    parser.add_argument('--parzen_sigmas', type=str, default='0.20') # parzen window bandwidth, or comma-separated bandwidths to choose from on the validation set
+    parser.add_argument('--parzen_cache', type=str, default='') # directory where the parzen distances are cached, for repeated evaluations of the same samples
    
     # argparse does not deal with bool 
     parser.add_argument('--vis_init', type=int, default=0)
     parser.add_argument('--noiseless_h1', type=int, default=1)
     parser.add_argument('--input_sampling', type=int, default=1)
     parser.add_argument('--test_model', type=int, default=0)
+    parser.add_argument('--resume', type=int, default=0) # continue training from the last checkpoint of the directory
+    parser.add_argument('--keep_last', type=int, default=0) # number of last checkpoints kept whole, 0 for all
+    parser.add_argument('--keep_every', type=int, default=0) # also keep the older checkpoints of every keep_every epochs
+    parser.add_argument('--keep_best', type=int, default=0) # also keep the older checkpoint with the best valid cost
+    parser.add_argument('--archive', type=str, default='') # store the older checkpoints kept as 'compressed' or 'float16' parameter archives
+    parser.add_argument('--function_cache', type=int, default=1) # reuse compiled functions across runs
+    parser.add_argument('--metrics_baseline', type=str, default='') # metrics.jsonl of an earlier run, compared to this one at the end
 
     args = parser.parse_args()
 
@@ -34,8 +34,11 @@ def main():
     parser.add_argument('--act', type=str, default='tanh')
     parser.add_argument('--dataset', type=str, default='MNIST')
     parser.add_argument('--data_path', type=str, default='.')
+    parser.add_argument('--memmap_path', type=str, default='') # directory of .npy splits, trained on out-of-core
+    parser.add_argument('--train_chunk_size', type=int, default=10000) # training rows in memory at once, with --memmap_path
     parser.add_argument('--missing_data_dir', type=str, default='.')
     parser.add_argument('--save_path', type=str, default='.')
+    parser.add_argument('--inpaint_batch_size', type=int, default=1000) # number of images inpainted together
    
     # argparse does not deal with bool 
     parser.add_argument('--vis_init', type=int, default=0)
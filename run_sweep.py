@@ -0,0 +1,198 @@
+'''
+Hyperparameter sweep over the options of run_gsn.py (or of another run_*.py script).
+
+Every point of the sweep is trained in its own directory of the sweep directory,
+by a separate process limited to --threads BLAS threads (and pinned to as many cores
+with taskset, when available), with up to --n_jobs processes at a time.
+The dataset is converted once into the memory-mapped cache of model.py before
+the runs start, and every run trains out-of-core from it (--memmap_path) :
+they all share the same pages of it, instead of each holding a copy of the training set.
+The final numbers of every run (results.json, see model.experiment) are collected
+into a table, results.txt, in the sweep directory.
+
+Grid search over every combination of the values :
+
+    python run_sweep.py --grid K=2,3 --grid learning_rate=0.1,0.25 -- --n_epoch 100
+
+Random search, with 20 points drawn from value lists or ranges (lo:hi uniform, log:lo:hi log-uniform) :
+
+    python run_sweep.py --n_random 20 --grid K=2,3 --grid learning_rate=log:0.01:1 --grid input_salt_and_pepper=0.2:0.6
+
+The options after -- are given to every run.
+'''
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import numpy
+from distutils.spawn import find_executable
+import model
+
+def parse_values(spec):
+    # 'a,b,c' is a list of values, 'lo:hi' and 'log:lo:hi' are ranges (random search only)
+    if spec.startswith('log:'):
+        lo, hi  =   spec[4:].split(':')
+        return ('log', float(lo), float(hi))
+    if ':' in spec:
+        lo, hi  =   spec.split(':')
+        return ('uniform', float(lo), float(hi))
+    return spec.split(',')
+
+def sweep_points(grid, n_random=0, seed=1):
+    # The option values of every run : all the combinations of the grid, or n_random random draws
+    names   =   [name for name, values in grid]
+    if not n_random:
+        for name, values in grid:
+            if isinstance(values, tuple):
+                raise ValueError('The range of ' + name + ' needs --n_random')
+        return [zip(names, combination) for combination in itertools.product(*[values for name, values in grid])]
+    rng     =   numpy.random.RandomState(seed)
+    points  =   []
+    for i in range(n_random):
+        point   =   []
+        for name, values in grid:
+            if isinstance(values, list):
+                value   =   values[rng.randint(len(values))]
+            elif values[0] == 'log':
+                value   =   '%.6g' % numpy.exp(rng.uniform(numpy.log(values[1]), numpy.log(values[2])))
+            else:
+                value   =   '%.6g' % rng.uniform(values[1], values[2])
+            point.append((name, value))
+        points.append(point)
+    return points
+
+def run_name(i, point):
+    return 'run_%03d_' % i + '_'.join(name + '=' + value for name, value in point)
+
+def cache_dataset(options):
+    # Convert the dataset of the runs into the cache of model.py once, before they start.
+    # Returns the directory of the cache, to train the runs from with --memmap_path
+    # ('' if --memmap_path is already given, or if the cache could not be written).
+    parser  =   argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='MNIST')
+    parser.add_argument('--data_path', type=str, default='.')
+    parser.add_argument('--memmap_path', type=str, default='')
+    args, _ =   parser.parse_known_args(options)
+    if args.memmap_path:
+        return ''
+    print 'Caching the dataset', args.dataset, 'of', args.data_path
+    if args.dataset == 'MNIST':
+        data    =   model.load_mnist(args.data_path)
+    elif args.dataset == 'MNIST_binary':
+        data    =   model.load_mnist_binary(args.data_path, packed=True)
+    elif args.dataset == 'TFD':
+        data    =   model.load_tfd(args.data_path)
+    else:
+        return ''
+    X   =   data[0][0]
+    if isinstance(X, model.PackedRows):
+        X   =   X.bits
+    if not isinstance(X, numpy.memmap):
+        print 'The runs load the dataset themselves'
+        return ''
+    return os.path.dirname(os.path.abspath(X.filename))
+
+def absolute_paths(options):
+    # The runs do not start in the current directory
+    options =   list(options)
+    for i, option in enumerate(options[:-1]):
+        if option in ['--data_path', '--memmap_path', '--parzen_cache', '--metrics_baseline'] and options[i + 1]:
+            options[i + 1]  =   os.path.abspath(options[i + 1])
+    if '--data_path' not in options:
+        options +=  ['--data_path', os.path.abspath('.')]
+    return options
+
+def start_run(script, run_dir, point, options, threads, cores):
+    # Start the training process of a point in run_dir, limited to threads BLAS threads, on cores if given
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir)
+    if not os.path.isfile(script):
+        # the scripts next to this one
+        script  =   os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    command =   [sys.executable, os.path.abspath(script)] + options
+    for name, value in point:
+        command +=  ['--' + name, value]
+    if cores is not None:
+        command =   ['taskset', '-c', ','.join(str(c) for c in cores)] + command
+    env     =   dict(os.environ)
+    for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        env[variable]   =   str(threads)
+    env['PYTHONPATH']   =   os.path.dirname(os.path.abspath(__file__)) + os.pathsep + env.get('PYTHONPATH', '')
+    log     =   open(os.path.join(run_dir, 'log.txt'), 'w')
+    return subprocess.Popen(command, cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def collect_results(sweep_dir, runs):
+    # One row per run, best valid cost first. Runs without results.json (failed or still running) come last.
+    columns =   ['epochs', 'train_cost', 'valid_cost', 'test_cost', 'best_valid_cost', 'best_epoch', 'parzen_log_likelihood', 'training_time']
+    rows    =   []
+    for name, point in runs:
+        results_file    =   os.path.join(sweep_dir, name, 'results.json')
+        results         =   json.load(open(results_file)) if os.path.isfile(results_file) else {}
+        rows.append((point, results))
+    rows.sort(key=lambda row: (row[1].get('best_valid_cost') is None, row[1].get('best_valid_cost')))
+    names   =   [name for name, value in runs[0][1]] if runs else []
+    lines   =   ['\t'.join(names + columns)]
+    for point, results in rows:
+        lines.append('\t'.join([value for name, value in point] + [str(results.get(c, '')) for c in columns]))
+    table   =   '\n'.join(lines) + '\n'
+    with open(os.path.join(sweep_dir, 'results.txt'), 'w') as f:
+        f.write(table)
+    return table
+
+def main():
+    parser = argparse.ArgumentParser(usage='%(prog)s [options] [-- options of every run]')
+    parser.add_argument('--script', type=str, default='run_gsn.py') # the run_*.py script trained at every point
+    parser.add_argument('--grid', type=str, action='append', default=[]) # name=a,b,c or, for random search, name=lo:hi or name=log:lo:hi
+    parser.add_argument('--n_random', type=int, default=0) # number of random points, 0 for the whole grid
+    parser.add_argument('--seed', type=int, default=1) # of the random search
+    parser.add_argument('--n_jobs', type=int, default=1) # runs at a time
+    parser.add_argument('--threads', type=int, default=1) # BLAS threads of every run
+    parser.add_argument('--pin', type=int, default=1) # pin every run to its own cores with taskset
+    parser.add_argument('--sweep_dir', type=str, default='sweep') # one directory per run in there
+
+    argv    =   sys.argv[1:]
+    options =   argv[argv.index('--') + 1:] if '--' in argv else []
+    args    =   parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+    grid    =   [(spec.split('=', 1)[0], parse_values(spec.split('=', 1)[1])) for spec in args.grid]
+    points  =   sweep_points(grid, args.n_random, args.seed)
+    runs    =   [(run_name(i, point), point) for i, point in enumerate(points)]
+    options =   absolute_paths(options)
+    print len(runs), 'runs in', args.sweep_dir
+
+    # the cache of the dataset of every run (the dataset can be an option of the grid)
+    caches  =   {}
+    run_options =   {}
+    for name, point in runs:
+        point_options   =   options + sum([['--' + n, value] for n, value in point], [])
+        key     =   tuple(point_options[i + 1] for i, option in enumerate(point_options[:-1]) if option in ['--dataset', '--data_path'])
+        if key not in caches:
+            caches[key] =   cache_dataset(point_options)
+        run_options[name]   =   options + (['--memmap_path', caches[key]] if caches[key] else [])
+
+    pin     =   args.pin and find_executable('taskset') is not None
+    slots   =   range(args.n_jobs)  # free slots, slot i runs on cores i*threads ... (i+1)*threads-1
+    running =   {}
+    pending =   list(runs)
+    while pending or running:
+        while pending and slots:
+            slot        =   slots.pop(0)
+            name, point =   pending.pop(0)
+            cores       =   [c % multiprocessing.cpu_count() for c in range(slot * args.threads, (slot + 1) * args.threads)] if pin else None
+            print 'Starting', name
+            running[slot]   =   (name, start_run(args.script, os.path.join(args.sweep_dir, name), point, run_options[name], args.threads, cores))
+        time.sleep(1)
+        for slot, (name, process) in running.items():
+            if process.poll() is not None:
+                print 'Finished', name, '' if process.returncode == 0 else '(failed, exit code ' + str(process.returncode) + ')'
+                del running[slot]
+                slots.append(slot)
+
+    print collect_results(args.sweep_dir, runs)
+
+if __name__ == '__main__':
+    main()